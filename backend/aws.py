@@ -0,0 +1,81 @@
+import os
+import threading
+
+
+# lazy AWS SDK access. boto3 is only imported the first time a client is needed,
+# and every client and resource comes from one shared boto3 session (created
+# without credentials, they are passed per client) so the EC2 service model JSON
+# is parsed once per process instead of once per request.
+#
+# AMBA_PREWARM_SDK=1 loads the SDK and the EC2 models when main.py is imported.
+# Run with a preloading server (gunicorn --preload -k uvicorn.workers.UvicornWorker)
+# and the forked workers share those pages copy-on-write.
+PREWARM_SDK = os.environ.get('AMBA_PREWARM_SDK', '') == '1'
+
+session = None
+# boto3 sessions are not thread-safe, client creation is serialized
+session_lock = threading.Lock()
+
+
+def get_session():
+    global session
+    if session is None:
+        with session_lock:
+            if session is None:
+                import boto3
+                session = boto3.session.Session()
+    return session
+
+
+# config is a botocore Config (see client_config), e.g. a bigger connection pool
+# for clients shared by many threads
+def client(service_name, aws_access_key_id, aws_secret_access_key, region_name, config=None):
+    shared = get_session()
+    with session_lock:
+        return shared.client(
+            service_name,
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+            region_name=region_name,
+            config=config
+        )
+
+
+def client_config(**kwargs):
+    get_session()
+    from botocore.config import Config
+    return Config(**kwargs)
+
+
+def resource(service_name, aws_access_key_id, aws_secret_access_key, region_name):
+    shared = get_session()
+    with session_lock:
+        return shared.resource(
+            service_name,
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+            region_name=region_name
+        )
+
+
+def sdk_loaded():
+    return session is not None
+
+
+# import the SDK and load the models the API uses, building a throwaway client
+# and resource makes botocore parse and cache the service, paginator and waiter JSON
+def prewarm(region_name='us-east-1'):
+    ec2 = client('ec2', 'prewarm', 'prewarm', region_name)
+    for operation in ('describe_instances', 'describe_volumes', 'describe_security_groups'):
+        ec2.get_paginator(operation)
+    client('sts', 'prewarm', 'prewarm', region_name)
+    resource('ec2', 'prewarm', 'prewarm', region_name)
+
+
+# a forked child must not inherit a lock held by another thread of the parent
+def reset_lock_after_fork():
+    global session_lock
+    session_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_lock_after_fork)
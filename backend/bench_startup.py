@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+
+# startup benchmark: starts the API the way it runs in production, with and
+# without AMBA_PREWARM_SDK, and reports
+# - seconds until GET / answers (time to first response)
+# - seconds for the first GET /health?sdk=true (what the first AWS request pays for the SDK)
+# - RSS and PSS of every worker process (PSS counts shared copy-on-write pages once)
+#
+# python bench_startup.py --workers 4
+# python bench_startup.py --workers 4 --server gunicorn   (forks workers after preloading main.py)
+
+
+def server_command(server, port, workers):
+    if server == 'gunicorn':
+        return [sys.executable, '-m', 'gunicorn', 'main:app', '--preload',
+                '-k', 'uvicorn.workers.UvicornWorker', '-w', str(workers), '-b', f"127.0.0.1:{port}"]
+    return [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port), '--workers', str(workers)]
+
+
+def get(url):
+    started = time.time()
+    with urllib.request.urlopen(url, timeout=60) as response:
+        response.read()
+    return time.time() - started
+
+
+def wait_for_server(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            get(url)
+            return True
+        except OSError:
+            time.sleep(0.01)
+    return False
+
+
+def children(pid):
+    found = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children") as file:
+            for child in file.read().split():
+                found.append(int(child))
+                found.extend(children(int(child)))
+    return found
+
+
+def memory_kb(pid):
+    memory = {}
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                memory['rss_kb'] = int(line.split()[1])
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as file:
+            for line in file:
+                if line.startswith('Pss:'):
+                    memory['pss_kb'] = int(line.split()[1])
+    except OSError:
+        pass
+    return memory
+
+
+def run(mode, server, port, workers):
+    env = dict(os.environ, AMBA_PREWARM_SDK='1' if mode == 'prewarm' else '0', AMBA_QUEUE_WORKERS='0')
+    base = f"http://127.0.0.1:{port}"
+    started = time.time()
+    process = subprocess.Popen(server_command(server, port, workers), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_for_server(f"{base}/"):
+            raise RuntimeError(f"{server} did not start")
+        first_response = time.time() - started
+        first_sdk_request = get(f"{base}/health?sdk=true")
+        workers_memory = [memory_kb(pid) for pid in children(process.pid)]
+        return {
+            'mode': mode,
+            'server': server,
+            'workers': workers,
+            'time_to_first_response': round(first_response, 3),
+            'first_sdk_request': round(first_sdk_request, 3),
+            'master': memory_kb(process.pid),
+            'per_worker': workers_memory,
+        }
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', choices=['uvicorn', 'gunicorn'], default='uvicorn')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    for mode in ('lazy', 'prewarm'):
+        print(json.dumps(run(mode, args.server, args.port, args.workers), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+import argparse
+import base64
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from work_queue import QUEUE_DB, connect
+
+
+# block-level snapshot transfer with the EBS direct APIs, for snapshots that
+# cannot be shared with modify_snapshot_attribute (default AWS managed key, org
+# policy). Blocks of the source snapshot are read with get_snapshot_block and
+# written into a new destination snapshot with put_snapshot_block by a bounded
+# pool of workers. list_snapshot_blocks only returns allocated blocks, and blocks
+# that read back as all zeros are not written either. Every written block index is
+# checkpointed, so an interrupted transfer resumes into the same pending snapshot.
+
+BLOCK_SIZE = 512 * 1024
+LIST_PAGE_SIZE = 10000
+WORKERS = 16
+# checkpoint every this many finished blocks
+CHECKPOINT_EVERY = 256
+# minutes AWS keeps a started snapshot open for writes (the maximum)
+SNAPSHOT_TIMEOUT = 4320
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS block_transfers (
+    source_snapshot_id TEXT PRIMARY KEY,
+    dest_snapshot_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    changed_blocks INTEGER NOT NULL DEFAULT 0,
+    skipped_blocks INTEGER NOT NULL DEFAULT 0,
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS block_transfer_blocks (
+    dest_snapshot_id TEXT NOT NULL,
+    block_index INTEGER NOT NULL,
+    written INTEGER NOT NULL,
+    PRIMARY KEY (dest_snapshot_id, block_index)
+);
+'''
+
+
+def open_checkpoints(path=QUEUE_DB):
+    conn = connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def checksum(data):
+    return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+
+def is_zero(data):
+    return data.count(0) == len(data)
+
+
+# every allocated block of the snapshot, page by page
+def list_blocks(ebs, snapshot_id):
+    kwargs = {'SnapshotId': snapshot_id, 'MaxResults': LIST_PAGE_SIZE}
+    while True:
+        response = ebs.list_snapshot_blocks(**kwargs)
+        for block in response['Blocks']:
+            yield block
+        if not response.get('NextToken'):
+            return
+        kwargs['NextToken'] = response['NextToken']
+
+
+def snapshot_volume_size(ebs, snapshot_id):
+    return ebs.list_snapshot_blocks(SnapshotId=snapshot_id, MaxResults=100)['VolumeSize']
+
+
+# copy one block, returns True if it was written and False if it was all zeros
+def copy_block(source_ebs, dest_ebs, source_snapshot_id, dest_snapshot_id, block):
+    response = source_ebs.get_snapshot_block(
+        SnapshotId=source_snapshot_id,
+        BlockIndex=block['BlockIndex'],
+        BlockToken=block['BlockToken']
+    )
+    data = response['BlockData'].read()
+    if response.get('Checksum') and checksum(data) != response['Checksum']:
+        raise ValueError(f"Checksum mismatch on block {block['BlockIndex']} of {source_snapshot_id}")
+    if is_zero(data):
+        return False
+    dest_ebs.put_snapshot_block(
+        SnapshotId=dest_snapshot_id,
+        BlockIndex=block['BlockIndex'],
+        BlockData=data,
+        DataLength=len(data),
+        Checksum=checksum(data),
+        ChecksumAlgorithm='SHA256'
+    )
+    return True
+
+
+# transfer a source snapshot into a new destination snapshot and return its ID.
+# resumes the checkpointed transfer of the same source snapshot if there is one
+def transfer_snapshot(source_ebs, dest_ebs, source_snapshot_id, workers=WORKERS, encrypted=False,
+                      kms_key_arn=None, description='Transferred snapshot for migration', path=QUEUE_DB):
+    conn = open_checkpoints(path)
+    try:
+        transfer = conn.execute(
+            'SELECT dest_snapshot_id, state FROM block_transfers WHERE source_snapshot_id = ?',
+            (source_snapshot_id,)).fetchone()
+        if transfer and transfer[1] == 'completed':
+            return transfer[0]
+
+        if transfer:
+            dest_snapshot_id = transfer[0]
+            done = {row[0] for row in conn.execute(
+                'SELECT block_index FROM block_transfer_blocks WHERE dest_snapshot_id = ?',
+                (dest_snapshot_id,))}
+            print(f"Resuming transfer of {source_snapshot_id} into {dest_snapshot_id}, "
+                  f"{len(done)} blocks already done")
+        else:
+            kwargs = {
+                'VolumeSize': snapshot_volume_size(source_ebs, source_snapshot_id),
+                'Description': description,
+                'ClientToken': str(uuid.uuid4()),
+                'Timeout': SNAPSHOT_TIMEOUT,
+            }
+            if encrypted:
+                kwargs['Encrypted'] = True
+                if kms_key_arn:
+                    kwargs['KmsKeyArn'] = kms_key_arn
+            dest_snapshot_id = dest_ebs.start_snapshot(**kwargs)['SnapshotId']
+            with conn:
+                conn.execute(
+                    "INSERT INTO block_transfers (source_snapshot_id, dest_snapshot_id, state, started_at) "
+                    "VALUES (?, ?, 'started', ?)",
+                    (source_snapshot_id, dest_snapshot_id, time.time()))
+            done = set()
+
+        finished = []
+
+        def checkpoint():
+            with conn:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO block_transfer_blocks (dest_snapshot_id, block_index, written) '
+                    'VALUES (?, ?, ?)',
+                    [(dest_snapshot_id, index, int(written)) for index, written in finished])
+            finished.clear()
+
+        # at most two blocks per worker in flight, so memory stays bounded
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            in_flight = {}
+            try:
+                for block in list_blocks(source_ebs, source_snapshot_id):
+                    if block['BlockIndex'] in done:
+                        continue
+                    while len(in_flight) >= workers * 2:
+                        completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in completed:
+                            finished.append((in_flight.pop(future), future.result()))
+                    future = pool.submit(copy_block, source_ebs, dest_ebs,
+                                         source_snapshot_id, dest_snapshot_id, block)
+                    in_flight[future] = block['BlockIndex']
+                    if len(finished) >= CHECKPOINT_EVERY:
+                        checkpoint()
+                for future in list(in_flight):
+                    finished.append((in_flight.pop(future), future.result()))
+            finally:
+                # keep whatever finished before a failure for the next attempt
+                for future in list(in_flight):
+                    if future.done() and not future.exception():
+                        finished.append((in_flight.pop(future), future.result()))
+                checkpoint()
+
+        changed, skipped = conn.execute(
+            'SELECT SUM(written), SUM(1 - written) FROM block_transfer_blocks WHERE dest_snapshot_id = ?',
+            (dest_snapshot_id,)).fetchone()
+        dest_ebs.complete_snapshot(SnapshotId=dest_snapshot_id, ChangedBlocksCount=changed or 0)
+        with conn:
+            conn.execute(
+                "UPDATE block_transfers SET state = 'completed', changed_blocks = ?, skipped_blocks = ?, "
+                "finished_at = ? WHERE source_snapshot_id = ?",
+                (changed or 0, skipped or 0, time.time(), source_snapshot_id))
+            conn.execute('DELETE FROM block_transfer_blocks WHERE dest_snapshot_id = ?', (dest_snapshot_id,))
+        return dest_snapshot_id
+    finally:
+        conn.close()
+
+
+# in-memory stand-in for the EBS direct APIs, same calls and response shapes
+# as the boto3 'ebs' client. latency (seconds per call) makes the worker scaling visible
+class LocalBlockStore:
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.snapshots = {}
+        self.lock = threading.Lock()
+
+    def add_snapshot(self, snapshot_id, volume_size, blocks):
+        self.snapshots[snapshot_id] = {'volume_size': volume_size, 'blocks': dict(blocks), 'status': 'completed'}
+
+    def list_snapshot_blocks(self, SnapshotId, MaxResults=LIST_PAGE_SIZE, NextToken=None, **kwargs):
+        snapshot = self.snapshots[SnapshotId]
+        indexes = sorted(snapshot['blocks'])
+        start = int(NextToken or 0)
+        page = indexes[start:start + MaxResults]
+        response = {
+            'Blocks': [{'BlockIndex': index, 'BlockToken': f"{SnapshotId}:{index}"} for index in page],
+            'VolumeSize': snapshot['volume_size'],
+            'BlockSize': BLOCK_SIZE,
+        }
+        if start + MaxResults < len(indexes):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def get_snapshot_block(self, SnapshotId, BlockIndex, BlockToken):
+        time.sleep(self.latency)
+        data = self.snapshots[SnapshotId]['blocks'][BlockIndex]
+        return {'DataLength': len(data), 'BlockData': io.BytesIO(data),
+                'Checksum': checksum(data), 'ChecksumAlgorithm': 'SHA256'}
+
+    def start_snapshot(self, VolumeSize, **kwargs):
+        snapshot_id = f"snap-local-{uuid.uuid4().hex[:12]}"
+        with self.lock:
+            self.snapshots[snapshot_id] = {'volume_size': VolumeSize, 'blocks': {}, 'status': 'pending'}
+        return {'SnapshotId': snapshot_id, 'Status': 'pending', 'BlockSize': BLOCK_SIZE}
+
+    def put_snapshot_block(self, SnapshotId, BlockIndex, BlockData, DataLength, Checksum, ChecksumAlgorithm):
+        time.sleep(self.latency)
+        if checksum(BlockData) != Checksum:
+            raise ValueError(f"Checksum mismatch on block {BlockIndex}")
+        with self.lock:
+            snapshot = self.snapshots[SnapshotId]
+            if snapshot['status'] != 'pending':
+                raise ValueError(f"Snapshot {SnapshotId} is {snapshot['status']}")
+            snapshot['blocks'][BlockIndex] = BlockData
+        return {'Checksum': Checksum, 'ChecksumAlgorithm': ChecksumAlgorithm}
+
+    def complete_snapshot(self, SnapshotId, ChangedBlocksCount, **kwargs):
+        with self.lock:
+            snapshot = self.snapshots[SnapshotId]
+            if len(snapshot['blocks']) != ChangedBlocksCount:
+                raise ValueError(f"Snapshot {SnapshotId} has {len(snapshot['blocks'])} blocks, "
+                                 f"expected {ChangedBlocksCount}")
+            snapshot['status'] = 'completed'
+        return {'Status': 'completed'}
+
+
+# python block_transfer.py --blocks 400 --latency 0.01
+# transfers a synthetic snapshot through LocalBlockStore with growing worker counts
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--blocks', type=int, default=400)
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16, 64])
+    args = parser.parse_args()
+
+    for workers in args.workers:
+        store = LocalBlockStore(latency=args.latency)
+        # every fourth block is zeros, the way a sparse volume looks
+        blocks = {index: (bytes(BLOCK_SIZE) if index % 4 == 0 else bytes([index % 251 + 1]) * BLOCK_SIZE)
+                  for index in range(args.blocks)}
+        store.add_snapshot('snap-source', 8, blocks)
+        path = os.path.join(tempfile.mkdtemp(), 'checkpoints.db')
+        started = time.time()
+        dest_snapshot_id = transfer_snapshot(store, store, 'snap-source', workers=workers, path=path)
+        seconds = time.time() - started
+        written = len(store.snapshots[dest_snapshot_id]['blocks'])
+        print(f"{workers} workers: {args.blocks} blocks ({written} written) in {seconds:.2f}s, "
+              f"{args.blocks * BLOCK_SIZE / seconds / 1024 / 1024:.1f} MiB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+import json
+import os
+import sqlite3
+import time
+
+
+# local inventory index: a sqlite copy of the instances, volumes, security groups
+# and tags of every account/region we have scanned, so the UI can filter large
+# fleets without describing the whole account again
+INVENTORY_DB = os.environ.get('AMBA_INVENTORY_DB', 'inventory.db')
+
+# how many rows describe_* should return per page
+PAGE_SIZE = 1000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS instances (
+    account_id TEXT NOT NULL,
+    region_name TEXT NOT NULL,
+    instance_id TEXT NOT NULL,
+    name TEXT,
+    state TEXT,
+    instance_type TEXT,
+    vpc_id TEXT,
+    subnet_id TEXT,
+    availability_zone TEXT,
+    private_ip TEXT,
+    public_ip TEXT,
+    launch_time TEXT,
+    generation INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (account_id, region_name, instance_id)
+);
+CREATE INDEX IF NOT EXISTS instances_state ON instances (account_id, region_name, state);
+CREATE INDEX IF NOT EXISTS instances_type ON instances (account_id, region_name, instance_type);
+CREATE INDEX IF NOT EXISTS instances_vpc ON instances (account_id, region_name, vpc_id, subnet_id);
+
+CREATE TABLE IF NOT EXISTS volumes (
+    account_id TEXT NOT NULL,
+    region_name TEXT NOT NULL,
+    volume_id TEXT NOT NULL,
+    instance_id TEXT,
+    size INTEGER,
+    volume_type TEXT,
+    state TEXT,
+    encrypted INTEGER,
+    availability_zone TEXT,
+    generation INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (account_id, region_name, volume_id)
+);
+CREATE INDEX IF NOT EXISTS volumes_instance ON volumes (account_id, region_name, instance_id);
+
+CREATE TABLE IF NOT EXISTS security_groups (
+    account_id TEXT NOT NULL,
+    region_name TEXT NOT NULL,
+    group_id TEXT NOT NULL,
+    group_name TEXT,
+    vpc_id TEXT,
+    description TEXT,
+    generation INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (account_id, region_name, group_id)
+);
+CREATE INDEX IF NOT EXISTS security_groups_vpc ON security_groups (account_id, region_name, vpc_id);
+
+CREATE TABLE IF NOT EXISTS tags (
+    account_id TEXT NOT NULL,
+    region_name TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (account_id, region_name, resource_id, key)
+);
+CREATE INDEX IF NOT EXISTS tags_key_value ON tags (key, value, resource_id);
+
+CREATE TABLE IF NOT EXISTS tag_docs (
+    doc_id INTEGER PRIMARY KEY,
+    account_id TEXT NOT NULL,
+    region_name TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    UNIQUE (account_id, region_name, resource_id)
+);
+
+CREATE TABLE IF NOT EXISTS refreshes (
+    account_id TEXT NOT NULL,
+    region_name TEXT NOT NULL,
+    generation INTEGER NOT NULL,
+    refreshed_at REAL NOT NULL,
+    PRIMARY KEY (account_id, region_name)
+);
+'''
+
+# full-text index over "key=value key value" of every tagged resource,
+# the fts rowid is the doc_id of the resource in tag_docs
+FTS_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS tags_fts USING fts5(body);
+'''
+
+# searchable resource types: table, id column and the columns that can be filtered on
+RESOURCE_TYPES = {
+    'instance': ('instances', 'instance_id',
+                 ['state', 'instance_type', 'vpc_id', 'subnet_id', 'availability_zone']),
+    'volume': ('volumes', 'volume_id',
+               ['instance_id', 'volume_type', 'state', 'availability_zone']),
+    'security_group': ('security_groups', 'group_id',
+                       ['vpc_id', 'group_name']),
+}
+
+
+def open_inventory(path=INVENTORY_DB):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    try:
+        conn.executescript(FTS_SCHEMA)
+    except sqlite3.OperationalError:
+        # sqlite built without fts5, text search falls back to LIKE on the tags table
+        pass
+    return conn
+
+
+def has_fts(conn):
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='tags_fts'").fetchone()
+    return row is not None
+
+
+def tags_to_dict(tags):
+    return {tag['Key']: tag.get('Value', '') for tag in tags or []}
+
+
+# rows for each describe_* resource: (id, column values, tags)
+def instance_row(instance):
+    tags = tags_to_dict(instance.get('Tags'))
+    return instance['InstanceId'], {
+        'name': tags.get('Name'),
+        'state': instance.get('State', {}).get('Name'),
+        'instance_type': instance.get('InstanceType'),
+        'vpc_id': instance.get('VpcId'),
+        'subnet_id': instance.get('SubnetId'),
+        'availability_zone': instance.get('Placement', {}).get('AvailabilityZone'),
+        'private_ip': instance.get('PrivateIpAddress'),
+        'public_ip': instance.get('PublicIpAddress'),
+        'launch_time': str(instance.get('LaunchTime', '')),
+    }, tags
+
+
+def volume_row(volume):
+    attachments = volume.get('Attachments') or [{}]
+    return volume['VolumeId'], {
+        'instance_id': attachments[0].get('InstanceId'),
+        'size': volume.get('Size'),
+        'volume_type': volume.get('VolumeType'),
+        'state': volume.get('State'),
+        'encrypted': int(bool(volume.get('Encrypted'))),
+        'availability_zone': volume.get('AvailabilityZone'),
+    }, tags_to_dict(volume.get('Tags'))
+
+
+def security_group_row(sg):
+    return sg['GroupId'], {
+        'group_name': sg.get('GroupName'),
+        'vpc_id': sg.get('VpcId'),
+        'description': sg.get('Description'),
+    }, tags_to_dict(sg.get('Tags'))
+
+
+def delete_tag_doc(conn, account_id, region_name, resource_id):
+    row = conn.execute(
+        'SELECT doc_id FROM tag_docs WHERE account_id = ? AND region_name = ? AND resource_id = ?',
+        (account_id, region_name, resource_id)).fetchone()
+    if row:
+        conn.execute('DELETE FROM tags_fts WHERE rowid = ?', (row[0],))
+        conn.execute('DELETE FROM tag_docs WHERE doc_id = ?', (row[0],))
+
+
+def upsert_rows(conn, resource_type, account_id, region_name, generation, rows):
+    table, id_column, _ = RESOURCE_TYPES[resource_type]
+    fts = has_fts(conn)
+    for resource_id, columns, tags, raw in rows:
+        names = [id_column] + list(columns) + ['generation', 'data']
+        values = [resource_id] + list(columns.values()) + \
+            [generation, json.dumps(raw, default=str)]
+        updates = ', '.join(f"{name} = excluded.{name}" for name in names[1:])
+        conn.execute(
+            f"INSERT INTO {table} (account_id, region_name, {', '.join(names)}) "
+            f"VALUES (?, ?, {', '.join('?' * len(names))}) "
+            f"ON CONFLICT (account_id, region_name, {id_column}) DO UPDATE SET {updates}",
+            [account_id, region_name] + values)
+
+        # tags are small, replace them wholesale
+        conn.execute('DELETE FROM tags WHERE account_id = ? AND region_name = ? AND resource_id = ?',
+                     (account_id, region_name, resource_id))
+        conn.executemany(
+            'INSERT INTO tags (account_id, region_name, resource_id, key, value) VALUES (?, ?, ?, ?, ?)',
+            [(account_id, region_name, resource_id, key, value) for key, value in tags.items()])
+        if fts:
+            delete_tag_doc(conn, account_id, region_name, resource_id)
+            if tags:
+                doc_id = conn.execute(
+                    'INSERT INTO tag_docs (account_id, region_name, resource_id) VALUES (?, ?, ?)',
+                    (account_id, region_name, resource_id)).lastrowid
+                body = ' '.join(f"{key}={value} {key} {value}" for key, value in tags.items())
+                conn.execute('INSERT INTO tags_fts (rowid, body) VALUES (?, ?)', (doc_id, body))
+
+
+# drop everything the latest refresh did not see anymore (terminated, deleted...)
+def prune_stale(conn, account_id, region_name, generation):
+    fts = has_fts(conn)
+    for table, id_column, _ in RESOURCE_TYPES.values():
+        stale = [row[0] for row in conn.execute(
+            f"SELECT {id_column} FROM {table} WHERE account_id = ? AND region_name = ? AND generation < ?",
+            (account_id, region_name, generation))]
+        for resource_id in stale:
+            conn.execute('DELETE FROM tags WHERE account_id = ? AND region_name = ? AND resource_id = ?',
+                         (account_id, region_name, resource_id))
+            if fts:
+                delete_tag_doc(conn, account_id, region_name, resource_id)
+        conn.execute(
+            f"DELETE FROM {table} WHERE account_id = ? AND region_name = ? AND generation < ?",
+            (account_id, region_name, generation))
+
+
+# refresh the index for one account/region from paginated describe calls,
+# every page is committed on its own so searches see the new rows right away
+def refresh_inventory(conn, ec2, account_id, region_name, max_age=0):
+    previous = conn.execute(
+        'SELECT generation, refreshed_at FROM refreshes WHERE account_id = ? AND region_name = ?',
+        (account_id, region_name)).fetchone()
+    if previous and max_age and time.time() - previous['refreshed_at'] < max_age:
+        return {'account_id': account_id, 'region_name': region_name,
+                'generation': previous['generation'], 'refreshed': False}
+
+    generation = (previous['generation'] if previous else 0) + 1
+    counts = {'instance': 0, 'volume': 0, 'security_group': 0}
+
+    for page in ec2.get_paginator('describe_instances').paginate(
+            PaginationConfig={'PageSize': PAGE_SIZE}):
+        rows = [instance_row(instance) + (instance,)
+                for reservation in page['Reservations']
+                for instance in reservation['Instances']]
+        with conn:
+            upsert_rows(conn, 'instance', account_id, region_name, generation, rows)
+        counts['instance'] += len(rows)
+
+    for page in ec2.get_paginator('describe_volumes').paginate(
+            PaginationConfig={'PageSize': PAGE_SIZE}):
+        rows = [volume_row(volume) + (volume,) for volume in page['Volumes']]
+        with conn:
+            upsert_rows(conn, 'volume', account_id, region_name, generation, rows)
+        counts['volume'] += len(rows)
+
+    for page in ec2.get_paginator('describe_security_groups').paginate(
+            PaginationConfig={'PageSize': PAGE_SIZE}):
+        rows = [security_group_row(sg) + (sg,) for sg in page['SecurityGroups']]
+        with conn:
+            upsert_rows(conn, 'security_group', account_id, region_name, generation, rows)
+        counts['security_group'] += len(rows)
+
+    with conn:
+        prune_stale(conn, account_id, region_name, generation)
+        conn.execute(
+            'INSERT INTO refreshes (account_id, region_name, generation, refreshed_at) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (account_id, region_name) DO UPDATE SET '
+            'generation = excluded.generation, refreshed_at = excluded.refreshed_at',
+            (account_id, region_name, generation, time.time()))
+    # keep the planner statistics fresh so tag lookups drive the queries
+    conn.execute('ANALYZE')
+
+    return {'account_id': account_id, 'region_name': region_name,
+            'generation': generation, 'refreshed': True, 'counts': counts}
+
+
+# turn free text into an fts5 query: every word must match, as a prefix
+def fts_query(text):
+    words = [word.replace('"', '""') for word in text.split()]
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+# search the index, never touches AWS.
+# results are ordered by resource id and paged with page_token = last id of the previous page
+def search_inventory(conn, resource_type='instance', account_id=None, region_name=None,
+                     filters=None, tags=None, text=None, page_token=None, page_size=100):
+    if resource_type not in RESOURCE_TYPES:
+        raise ValueError(f"Unknown resource type {resource_type}")
+    table, id_column, filterable = RESOURCE_TYPES[resource_type]
+
+    where = []
+    params = []
+    if account_id:
+        where.append('r.account_id = ?')
+        params.append(account_id)
+    if region_name:
+        where.append('r.region_name = ?')
+        params.append(region_name)
+
+    for column, value in (filters or {}).items():
+        if column not in filterable:
+            raise ValueError(f"Cannot filter {resource_type} on {column}")
+        if isinstance(value, list):
+            where.append(f"r.{column} IN ({', '.join('?' * len(value))})")
+            params.extend(value)
+        else:
+            where.append(f"r.{column} = ?")
+            params.append(value)
+
+    # exact tag match, "*" matches any value of the key
+    for key, value in (tags or {}).items():
+        if value in (None, '', '*'):
+            where.append(f"r.{id_column} IN (SELECT t.resource_id FROM tags t WHERE t.key = ?)")
+            params.append(key)
+        else:
+            where.append(f"r.{id_column} IN (SELECT t.resource_id FROM tags t WHERE t.key = ? AND t.value = ?)")
+            params.extend([key, value])
+
+    if text and text.strip():
+        if has_fts(conn):
+            where.append(f"r.{id_column} IN (SELECT d.resource_id FROM tag_docs d WHERE d.doc_id IN "
+                         "(SELECT rowid FROM tags_fts WHERE tags_fts MATCH ?))")
+            params.append(fts_query(text))
+        else:
+            where.append(f"r.{id_column} IN (SELECT t.resource_id FROM tags t "
+                         "WHERE (t.key || '=' || t.value) LIKE ?)")
+            params.append(f"%{text.strip()}%")
+
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+    total = conn.execute(f"SELECT COUNT(*) FROM {table} r {where_sql}", params).fetchone()[0]
+
+    if page_token:
+        where.append(f"r.{id_column} > ?")
+        params.append(page_token)
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+    rows = conn.execute(
+        f"SELECT * FROM {table} r {where_sql} ORDER BY r.{id_column} LIMIT ?",
+        params + [page_size + 1]).fetchall()
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    items = []
+    for row in rows:
+        item = {key: row[key] for key in row.keys() if key not in ('generation', 'data')}
+        item['tags'] = {tag['key']: tag['value'] for tag in conn.execute(
+            'SELECT key, value FROM tags WHERE account_id = ? AND region_name = ? AND resource_id = ?',
+            (row['account_id'], row['region_name'], row[id_column]))}
+        items.append(item)
+
+    return {
+        'items': items,
+        'total': total,
+        'next_page_token': rows[-1][id_column] if has_more else None,
+    }
@@ -1,16 +1,31 @@
-from typing import Union
+from typing import Dict, List, Optional, Union
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from pydantic import BaseModel
-import boto3
 import datetime
 import time
+from contextlib import nullcontext
 from fastapi.middleware.cors import CORSMiddleware
 import os
 
+import aws
+from block_transfer import transfer_snapshot
+from inventory import open_inventory, refresh_inventory, search_inventory
+from planner import describe_wave, plan_wave, record_stage, stage_throughput
+from readiness import InstancesNotReady, not_ready, verify_instances
+from responses import compact_response
+from topology import TopologyError, replicate_once
+from work_queue import (PRIORITIES, DuplicateJob, enqueue_job, get_account_limits, get_job, list_jobs,
+                        open_queue, save_progress, set_account_limit, set_tenant_weight, stage_slots,
+                        start_workers)
+
 
 app = FastAPI()
 
+# load the AWS SDK now instead of on the first request (see aws.py)
+if aws.PREWARM_SDK:
+    aws.prewarm()
+
 
 # CORS Middleware
 app.add_middleware(
@@ -39,18 +54,98 @@ class MigrationRequest(BaseModel):
     dest_aws_secret_access_key: str
     dest_region_name: str
     instance_id: str
+    # "replicate" copies the instance's whole VPC (subnets, route tables, gateways,
+    # security groups) once per destination account and launches into the copies of
+    # its subnet and groups, every migration from the same VPC reuses the copy
     selected_vpc_id: str
     selected_subnet_id: str
     selected_security_group_id: str
+    # launch this many copies of the instance from the migrated AMI,
+    # spread over replica_subnet_ids (defaults to the selected subnet), a single
+    # copy goes into the first of them
+    replica_count: int = 1
+    replica_subnet_ids: List[str] = []
+    # wait for the launched instances to pass their status checks (and open probe_ports),
+    # an instance that does not within ready_timeout fails the migration
+    verify_ready: bool = True
+    probe_ports: List[int] = []
+    ready_timeout: int = 900
+    # scheduling of queued migrations: fair share per team (defaults to the
+    # source account), and cutover jobs go before rehearsal jobs
+    team: Optional[str] = None
+    priority: str = 'rehearsal'
+    # how snapshots reach the destination: "share" (modify_snapshot_attribute + copy_snapshot),
+    # "blocks" (EBS direct APIs, for snapshots that cannot be shared) or "auto" (share, else blocks)
+    transfer_mode: str = 'share'
+    transfer_workers: int = 16
+    # source zone -> destination zone for a replicated VPC, see topology.map_availability_zones
+    availability_zones: Dict[str, str] = {}
+
+
+class TopologyRequest(BaseModel):
+    source_aws_access_key_id: str
+    source_aws_secret_access_key: str
+    source_region_name: str
+    dest_aws_access_key_id: str
+    dest_aws_secret_access_key: str
+    dest_region_name: str
+    vpc_id: str
+    workers: int = 16
+    # source zone -> destination zone, by default matched by zone ID or position
+    availability_zones: Dict[str, str] = {}
+
+
+class AccountLimitRequest(BaseModel):
+    account_id: str
+    max_running: int
+    # volumes snapshotting / copying at the same time, unset keeps the current cap
+    max_snapshots: Optional[int] = None
+    max_copies: Optional[int] = None
+
+
+class TenantWeightRequest(BaseModel):
+    tenant: str  # a team, or a source account ID for jobs queued without a team
+    weight: float
+
+
+class PlanRequest(BaseModel):
+    aws_access_key_id: str
+    aws_secret_access_key: str
+    region_name: str
+    instance_ids: List[str] = []  # empty plans every instance of the account
+    # the queue's caps for the source account when not given
+    max_parallelism: Optional[int] = None
+    snapshot_concurrency: Optional[int] = None
+    copy_concurrency: Optional[int] = None
+
+
+class InventoryRequest(BaseModel):
+    aws_access_key_id: str
+    aws_secret_access_key: str
+    region_name: str
+    # skip the refresh if the index is younger than this many seconds
+    max_age: int = 0
+
+
+class InventorySearchRequest(BaseModel):
+    account_id: Optional[str] = None
+    region_name: Optional[str] = None
+    resource_type: str = 'instance'  # instance, volume or security_group
+    filters: Dict[str, Union[str, List[str]]] = {}
+    tags: Dict[str, str] = {}  # exact tag match, "*" matches any value
+    text: Optional[str] = None  # full-text search over tag keys and values
+    page_token: Optional[str] = None
+    page_size: int = 100
 
 
 def create_ec2_client(aws_access_key_id, aws_secret_access_key, region_name):
-    return boto3.client(
-        'ec2',
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key,
-        region_name=region_name
-    )
+    return aws.client('ec2', aws_access_key_id, aws_secret_access_key, region_name)
+
+
+# get the account ID of a set of credentials
+def get_account_id(aws_access_key_id, aws_secret_access_key, region_name):
+    sts = aws.client('sts', aws_access_key_id, aws_secret_access_key, region_name)
+    return sts.get_caller_identity()['Account']
 
 
 # establish a connection to the source and destination ec2 clients
@@ -69,41 +164,37 @@ def establish_connection(request):
 
 
 @app.post("/list-instances")
-def list_instances(credentials: Credentials):
-    ec2 = boto3.client(
-        'ec2',
-        aws_access_key_id=credentials.aws_access_key_id,
-        aws_secret_access_key=credentials.aws_secret_access_key,
-        region_name=credentials.region_name
-    )
+def list_instances(credentials: Credentials, http_request: Request):
+    ec2 = create_ec2_client(credentials.aws_access_key_id,
+                            credentials.aws_secret_access_key, credentials.region_name)
     instances = ec2.describe_instances()
     instance_ids = [instance['InstanceId'] for reservation in instances['Reservations']
                     for instance in reservation['Instances']]
-    return {"instances": instance_ids}
+    return compact_response(http_request, {"instances": instance_ids})
 
 
 # list vpcs: /list-vpcs
 @app.post("/list-vpcs")
-def list_vpcs(credentials: Credentials):
+def list_vpcs(credentials: Credentials, http_request: Request):
     ec2 = create_ec2_client(credentials.aws_access_key_id,
                             credentials.aws_secret_access_key, credentials.region_name)
     vpcs = ec2.describe_vpcs()
     vpc_ids = [vpc['VpcId'] for vpc in vpcs['Vpcs']]
-    return {"vpcs": vpc_ids}
+    return compact_response(http_request, {"vpcs": vpc_ids})
 
 # list subnets: /list-subnets
 # only list subnets that are associated with the selected VPC
 
 
 @app.post("/list-subnets")
-def list_subnets(request: Credentials):
+def list_subnets(request: Credentials, http_request: Request):
     ec2 = create_ec2_client(request.aws_access_key_id,
                             request.aws_secret_access_key, request.region_name)
     subnets = ec2.describe_subnets(Filters=[
         {'Name': 'vpc-id', 'Values': [request.vpc_id]}
     ])
     subnet_ids = [subnet['SubnetId'] for subnet in subnets['Subnets']]
-    return {"subnets": subnet_ids}
+    return compact_response(http_request, {"subnets": subnet_ids})
 
 
 # create a subnet
@@ -175,7 +266,7 @@ def create_subnet(self, instance, dest_vpc_id):
 # list security groups: /list-security-groups
 # only list security groups that are associated with the selected VPC2
 @app.post("/list-security-groups")
-def list_security_groups(request: Credentials):
+def list_security_groups(request: Credentials, http_request: Request):
     print("request from security group: ", request)
     ec2 = create_ec2_client(request.aws_access_key_id,
                             request.aws_secret_access_key, request.region_name)
@@ -184,7 +275,7 @@ def list_security_groups(request: Credentials):
     ])
     security_group_ids = [sg['GroupId']
                           for sg in security_groups['SecurityGroups']]
-    return {"security_groups": security_group_ids}
+    return compact_response(http_request, {"security_groups": security_group_ids})
 
 
 # create a security group: /create-security-group
@@ -226,14 +317,14 @@ def create_security_group(self, instance, dest_vpc_id):
 
 # list key pairs: /list-key-pairs
 @app.post("/list-key-pairs")
-def list_key_pairs(credentials: Credentials):
+def list_key_pairs(credentials: Credentials, http_request: Request):
     ec2 = create_ec2_client(
         credentials.aws_access_key_id, credentials.aws_secret_access_key, credentials.region_name
     )
     key_pairs = ec2.describe_key_pairs()
     key_pair_names = [key_pair['KeyName']
                       for key_pair in key_pairs['KeyPairs']]
-    return {"key_pairs": key_pair_names}
+    return compact_response(http_request, {"key_pairs": key_pair_names})
 
 
 '''
@@ -274,70 +365,200 @@ Steps:
 
 @app.post("/migrate-instance")
 def migrate_instance(request: MigrationRequest):
+    validate_migration(request)
+    try:
+        return run_migration(request)
+    except TopologyError as e:
+        raise HTTPException(status_code=502, detail={"error": str(e), "created": e.created})
+    except ReplicaLaunchError as e:
+        raise HTTPException(status_code=502, detail={"error": str(e), "instance_ids": e.instance_ids})
+    except InstancesNotReady as e:
+        raise HTTPException(status_code=504, detail={"error": str(e), **e.result})
+
+
+# reject requests that would fail halfway through the migration
+def validate_migration(request):
+    if request.replica_count < 1:
+        raise HTTPException(status_code=400, detail="replica_count must be at least 1")
+    if not request.replica_subnet_ids:
+        return
+    if request.selected_vpc_id in ('new', 'replicate'):
+        raise HTTPException(status_code=400,
+                            detail="replica_subnet_ids need an existing selected_vpc_id")
+
+    dest_ec2 = create_ec2_client(request.dest_aws_access_key_id,
+                                 request.dest_aws_secret_access_key, request.dest_region_name)
+    try:
+        subnets = dest_ec2.describe_subnets(SubnetIds=request.replica_subnet_ids)['Subnets']
+        groups = [] if request.selected_security_group_id in ('new', 'replicate') else \
+            dest_ec2.describe_security_groups(GroupIds=[request.selected_security_group_id])['SecurityGroups']
+    except dest_ec2.exceptions.ClientError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    outside = [resource.get('SubnetId') or resource['GroupId'] for resource in subnets + groups
+               if resource['VpcId'] != request.selected_vpc_id]
+    if outside:
+        raise HTTPException(status_code=400,
+                            detail=f"{', '.join(outside)} not in VPC {request.selected_vpc_id}")
+
+
+# the migration pipeline, used by /migrate-instance and by the queue workers.
+# queued jobs hold their account's snapshot and copy slots while those stages run,
+# and record every finished step so a retried job resumes after it instead of
+# creating its snapshots, AMI, VPC or instances a second time
+def run_migration(request, job=None):
     # Establish connections to the source and destination EC2 clients
     source_ec2, dest_ec2 = establish_connection(request)
 
+    # steps finished by earlier attempts of the job
+    progress = dict(job['progress']) if job else {}
+
+    def checkpoint(**steps):
+        progress.update(steps)
+        if job:
+            save_progress(job, progress)
+
     # create a session for the destination ec2 resources
-    dest_ec2_resource = boto3.resource(
+    dest_ec2_resource = aws.resource(
         'ec2',
-        aws_access_key_id=request.dest_aws_access_key_id,
-        aws_secret_access_key=request.dest_aws_secret_access_key,
-        region_name=request.dest_region_name
+        request.dest_aws_access_key_id,
+        request.dest_aws_secret_access_key,
+        request.dest_region_name
     )
 
     # describe the selected instance
     instance = source_ec2.describe_instances(
         InstanceIds=[request.instance_id])['Reservations'][0]['Instances'][0]
 
-    # Get the VPC ID (Or create a new one if needed)
-    if request.selected_vpc_id == 'new':
+    # Get the VPC ID (Or create a new one, or replicate the instance's VPC, if needed)
+    created = None
+    if 'vpc_id' in progress:
+        vpc_id = progress['vpc_id']
+        created = progress.get('topology')
+    elif request.selected_vpc_id == 'new':
         vpc_id = create_vpc(dest_ec2)
+        checkpoint(vpc_id=vpc_id)
+    elif request.selected_vpc_id == 'replicate':
+        topology = replicate_once(
+            source_ec2, dest_ec2, instance['VpcId'], request.dest_account_id, request.dest_region_name,
+            zones=request.availability_zones)
+        vpc_id = topology['vpc_id']
+        created = topology['created']
+        checkpoint(vpc_id=vpc_id, topology=created)
     else:
         vpc_id = request.selected_vpc_id
 
     print("VPC ID: ", vpc_id)
 
     # Get the subnet ID (Or create a new one if needed)
-    if request.selected_subnet_id == 'new':
+    if 'subnet_id' in progress:
+        subnet_id = progress['subnet_id']
+    elif created and request.selected_subnet_id in ('new', 'replicate'):
+        if f"subnet:{instance['SubnetId']}" not in created:
+            raise ValueError(f"Subnet {instance['SubnetId']} was not replicated, see the replication's skipped list")
+        subnet_id = created[f"subnet:{instance['SubnetId']}"]
+    elif request.selected_subnet_id == 'new':
         subnet_id = create_subnet(instance, vpc_id)
+        checkpoint(subnet_id=subnet_id)
     else:
         subnet_id = request.selected_subnet_id
 
     print("Subnet ID: ", subnet_id)
 
     # Get the security group IDs (Or create a new one if needed)
-    if request.selected_security_group_id == 'new':
+    if 'security_group_ids' in progress:
+        security_group_ids = progress['security_group_ids']
+    elif created and request.selected_security_group_id in ('new', 'replicate'):
+        security_group_ids = [created[f"sg:{sg['GroupId']}"] for sg in instance['SecurityGroups']]
+    elif request.selected_security_group_id == 'new':
         security_group_ids = create_security_group(instance, vpc_id)
+        checkpoint(security_group_ids=security_group_ids)
     else:
         security_group_ids = [request.selected_security_group_id]
 
     print("Security Group IDs: ", security_group_ids)
 
-    # Create Snapshot of the instance's volumes
-    snapshot_ids = create_instance_snapshots(instance, source_ec2)
-
-    # Wait for the snapshots to be completed
-    wait_for_snapshots(snapshot_ids, source_ec2)
-
-    # Share and copy snapshots to the destination account
-    snapshot_copy_ids = share_and_copy_snapshots(
-        snapshot_ids, source_ec2,  request.dest_account_id, dest_ec2)
-
-    # Wait for the copied snapshots to be completed
-    wait_for_copied_snapshots(snapshot_copy_ids, dest_ec2)
+    volume_count = len([volume for volume in instance['BlockDeviceMappings'] if 'Ebs' in volume])
+
+    if 'snapshots_completed' not in progress:
+        with stage_slots(job, 'snapshot', volume_count) if job else nullcontext():
+            # Create Snapshot of the instance's volumes
+            started = time.time()
+            resumed = 'snapshot_ids' in progress
+            if not resumed:
+                checkpoint(snapshot_ids=create_instance_snapshots(instance, source_ec2))
+
+            # Wait for the snapshots to be completed
+            completed = wait_for_snapshots(progress['snapshot_ids'], source_ec2)
+            if not resumed:
+                record_volume_stages('snapshot', started, completed)
+            checkpoint(snapshots_completed=True)
+    snapshot_ids = progress['snapshot_ids']
+
+    if 'copies_completed' not in progress:
+        with stage_slots(job, 'copy', volume_count) if job else nullcontext():
+            # Share and copy (or transfer) snapshots to the destination account
+            started = time.time()
+            resumed = 'snapshot_copy_ids' in progress or 'copies' in progress
+            # every copy is recorded as soon as it is started (or transferred), and the
+            # retry of a job keeps its source snapshots, so nothing is copied twice
+            if 'snapshot_copy_ids' not in progress:
+                checkpoint(snapshot_copy_ids=transfer_snapshots(
+                    request, snapshot_ids, source_ec2, dest_ec2, progress.get('copies'),
+                    lambda copies: checkpoint(copies=copies)))
+
+            # Wait for the copied snapshots to be completed
+            completed = wait_for_copied_snapshots(progress['snapshot_copy_ids'], dest_ec2)
+            if not resumed:
+                record_volume_stages('copy', started, completed)
+            checkpoint(copies_completed=True)
+    snapshot_copy_ids = progress['snapshot_copy_ids']
 
     # Create an AMI from the copied snapshots
-    ami_id = create_ami(instance, snapshot_copy_ids, dest_ec2)
+    if 'ami_id' not in progress:
+        checkpoint(ami_id=create_ami(instance, snapshot_copy_ids, dest_ec2))
+    ami_id = progress['ami_id']
 
     # create a new key pair
     key_name = f"key-{instance['InstanceId']}"
     key_pair_name = create_key_pair(dest_ec2, key_name)
 
-    # Launch the instance
-    instance_id = launch_instance(
-        ami_id, subnet_id, security_group_ids, key_pair_name, instance, dest_ec2_resource)
-
-    return {"instance_id": instance_id}
+    # a queued job launches with a client token, so a retry gets the instances
+    # of the earlier attempt back from RunInstances instead of new ones
+    client_token = f"amba-{job['job_id']}" if job else None
+
+    # the launch time is saved with the instances, so a retry gives them
+    # the rest of ready_timeout and not a fresh one
+    if 'instance_ids' not in progress:
+        launched_at = time.time()
+        if request.replica_count > 1:
+            # Launch the replicas from the same AMI in batched calls
+            instance_ids = launch_replicas(
+                ami_id, request.replica_subnet_ids or [subnet_id], security_group_ids, key_pair_name,
+                instance, request.replica_count, dest_ec2_resource, client_token)
+        else:
+            # Launch the instance
+            instance_ids = [launch_instance(
+                ami_id, (request.replica_subnet_ids or [subnet_id])[0], security_group_ids,
+                key_pair_name, instance, dest_ec2_resource, client_token)]
+        checkpoint(instance_ids=instance_ids, launched_at=launched_at)
+    instance_ids = progress['instance_ids']
+    launched_at = progress.get('launched_at', time.time())
+
+    result = {"instance_id": instance_ids[0]}
+    if request.replica_count > 1:
+        result["instance_ids"] = instance_ids
+
+    # Verify the instances came up, through the poller shared by every migration to this account
+    if request.verify_ready:
+        result["readiness"] = verify_instances(
+            f"{request.dest_aws_access_key_id}:{request.dest_region_name}", dest_ec2, instance_ids,
+            ports=request.probe_ports, timeout=request.ready_timeout, started=launched_at)
+        failed = not_ready(result["readiness"])
+        if failed:
+            raise InstancesNotReady(
+                f"{', '.join(failed)} not ready after {request.ready_timeout} seconds", result)
+
+    return result
 
 
 # create a new VPC
@@ -356,6 +577,15 @@ def create_vpc(dest_ec2):
     )
     return vpc_id
 
+
+# one sample per volume for the planner's throughput history: its size and the
+# seconds from the start of the stage until its snapshot completed. The planner
+# simulates every volume on its own, so the samples must not be per instance
+def record_volume_stages(stage, started, completed):
+    for size, completed_at in completed.values():
+        record_stage(stage, size, completed_at - started)
+
+
 # create snapshots of the instance's volumes
 
 
@@ -370,21 +600,23 @@ def create_instance_snapshots(instance, source_ec2):
     return snapshots
 
 
-#  wait for snapshots to be completed
+#  wait for snapshots to be completed, returns the size and completion time of each
 def wait_for_snapshots(snapshots, source_ec2):
-    for snapshot_id in snapshots:
-        while True:
-            response = source_ec2.describe_snapshots(
-                SnapshotIds=[snapshot_id])
-            snapshot_status = response['Snapshots'][0]['State']
-            if snapshot_status == 'completed':
-                break
+    completed = {}
+    while len(completed) < len(snapshots):
+        pending = [snapshot_id for snapshot_id in snapshots if snapshot_id not in completed]
+        response = source_ec2.describe_snapshots(SnapshotIds=pending)
+        for snapshot in response['Snapshots']:
+            if snapshot['State'] == 'completed':
+                completed[snapshot['SnapshotId']] = (snapshot['VolumeSize'], time.time())
+        if len(completed) < len(snapshots):
             time.sleep(5)
+    return completed
 
 # share and copy snapshots to the destination account
 
 
-def share_and_copy_snapshots(snapshot_ids, source_ec2, dest_account_id, dest_ec2):
+def share_snapshots(snapshot_ids, source_ec2, dest_account_id):
     for snapshot_id in snapshot_ids:
         source_ec2.modify_snapshot_attribute(
             SnapshotId=snapshot_id,
@@ -392,27 +624,68 @@ def share_and_copy_snapshots(snapshot_ids, source_ec2, dest_account_id, dest_ec2
             OperationType='add',
             UserIds=[dest_account_id]
         )
-    copied_snapshots = []
-    for snapshot_id in snapshot_ids:
-        copied_snapshot = dest_ec2.copy_snapshot(
-            SourceRegion=source_ec2.meta.region_name,
-            SourceSnapshotId=snapshot_id,
-            Description='Copied snapshot for migration'
-        )
-        copied_snapshots.append(copied_snapshot['SnapshotId'])
-    return copied_snapshots
+
+
+def copy_shared_snapshot(snapshot_id, source_ec2, dest_ec2):
+    copied_snapshot = dest_ec2.copy_snapshot(
+        SourceRegion=source_ec2.meta.region_name,
+        SourceSnapshotId=snapshot_id,
+        Description='Copied snapshot for migration'
+    )
+    return copied_snapshot['SnapshotId']
+
+
+# get the snapshots into the destination account with the request's transfer mode.
+# copies maps the source snapshots already done (by an earlier attempt of the job) to
+# their copies, on_copy(copies) is called after each new one so the job can record it.
+# "auto" only falls back to blocks when sharing fails, before any copy was started
+def transfer_snapshots(request, snapshot_ids, source_ec2, dest_ec2, copies=None, on_copy=None):
+    if request.transfer_mode not in ('share', 'blocks', 'auto'):
+        raise ValueError(f"Unknown transfer mode {request.transfer_mode}")
+    copies = dict(copies or {})
+    pending = [snapshot_id for snapshot_id in snapshot_ids if snapshot_id not in copies]
+
+    def copied(snapshot_id, copy_id):
+        copies[snapshot_id] = copy_id
+        if on_copy:
+            on_copy(copies)
+
+    mode = request.transfer_mode
+    if mode != 'blocks':
+        try:
+            share_snapshots(pending, source_ec2, request.dest_account_id)
+            mode = 'share'
+        except source_ec2.exceptions.ClientError as e:
+            if mode == 'share':
+                raise e
+            print(f"Sharing snapshots failed, transferring blocks instead: {e}")
+            mode = 'blocks'
+
+    if mode == 'share':
+        for snapshot_id in pending:
+            copied(snapshot_id, copy_shared_snapshot(snapshot_id, source_ec2, dest_ec2))
+    elif pending:
+        # one pooled connection per worker (botocore keeps 10 by default, more workers
+        # would open a new connection per call), adaptive retries back off when throttled
+        config = aws.client_config(max_pool_connections=request.transfer_workers,
+                                   retries={'mode': 'adaptive'})
+        source_ebs = aws.client('ebs', request.source_aws_access_key_id,
+                                request.source_aws_secret_access_key, request.source_region_name, config)
+        dest_ebs = aws.client('ebs', request.dest_aws_access_key_id,
+                              request.dest_aws_secret_access_key, request.dest_region_name, config)
+        snapshots = source_ec2.describe_snapshots(SnapshotIds=pending)['Snapshots']
+        encrypted = {snapshot['SnapshotId']: snapshot['Encrypted'] for snapshot in snapshots}
+        # an interrupted transfer of the same source snapshot resumes block by block
+        for snapshot_id in pending:
+            copied(snapshot_id, transfer_snapshot(source_ebs, dest_ebs, snapshot_id,
+                                                  workers=request.transfer_workers,
+                                                  encrypted=encrypted[snapshot_id]))
+    return [copies[snapshot_id] for snapshot_id in snapshot_ids]
 
 
 # wait for copied snapshots to be completed
 def wait_for_copied_snapshots(snapshots, dest_ec2):
-    for snapshot_id in snapshots:
-        while True:
-            response = dest_ec2.describe_snapshots(
-                SnapshotIds=[snapshot_id])
-            snapshot_status = response['Snapshots'][0]['State']
-            if snapshot_status == 'completed':
-                break
-            time.sleep(5)
+    return wait_for_snapshots(snapshots, dest_ec2)
 
 # create an AMI from the copied snapshots
 
@@ -472,7 +745,8 @@ def create_key_pair(dest_ec2, key_name):
 
 
 #  launch the instance
-def launch_instance(ami_id, subnet_id, security_group_ids, key_name, source_ec2, dest_ec2_resource):
+def launch_instance(ami_id, subnet_id, security_group_ids, key_name, source_ec2, dest_ec2_resource,
+                    client_token=None):
     instance_type = source_ec2['InstanceType']
     unique_instance_name = f"Instance-from-AMI-{
         datetime.datetime.now().strftime('%Y%m%d%H%M%S')}"
@@ -480,6 +754,7 @@ def launch_instance(ami_id, subnet_id, security_group_ids, key_name, source_ec2,
     try:
         # Launch the instance
         new_instance = dest_ec2_resource.create_instances(
+            **({'ClientToken': client_token} if client_token else {}),
             ImageId=ami_id,
             MinCount=1,
             MaxCount=1,
@@ -504,9 +779,244 @@ def launch_instance(ami_id, subnet_id, security_group_ids, key_name, source_ec2,
         raise
 
 
+# some replicas were launched before a RunInstances call failed, instance_ids has them
+class ReplicaLaunchError(Exception):
+    def __init__(self, message, instance_ids):
+        super().__init__(message)
+        self.instance_ids = instance_ids
+
+
+# launch count copies of the migrated instance, spread round-robin over the subnets.
+# one RunInstances call per subnet, MinCount makes each call all-or-nothing
+def launch_replicas(ami_id, subnet_ids, security_group_ids, key_name, source_ec2, count, dest_ec2_resource,
+                    client_token=None):
+    instance_type = source_ec2['InstanceType']
+    unique_instance_name = f"Instance-from-AMI-{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}"
+    per_subnet = [count // len(subnet_ids) + (1 if i < count % len(subnet_ids) else 0)
+                  for i in range(len(subnet_ids))]
+
+    instance_ids = []
+    for index, (subnet_id, subnet_count) in enumerate(zip(subnet_ids, per_subnet)):
+        if subnet_count == 0:
+            continue
+        try:
+            new_instances = dest_ec2_resource.create_instances(
+                **({'ClientToken': f"{client_token}-{index}"} if client_token else {}),
+                ImageId=ami_id,
+                MinCount=subnet_count,
+                MaxCount=subnet_count,
+                InstanceType=instance_type,
+                KeyName=key_name,
+                NetworkInterfaces=[{
+                    'SubnetId': subnet_id,
+                    'DeviceIndex': 0,
+                    'AssociatePublicIpAddress': True,
+                    'Groups': security_group_ids
+                }],
+                TagSpecifications=[{
+                    'ResourceType': 'instance',
+                    'Tags': [
+                        {'Key': 'Name', 'Value': unique_instance_name},
+                        {'Key': 'amba:replica-of', 'Value': source_ec2['InstanceId']}
+                    ]
+                }]
+            )
+        except Exception as e:
+            print(f"Error launching {subnet_count} replicas in {subnet_id}: {e}")
+            if not instance_ids:
+                raise
+            raise ReplicaLaunchError(
+                f"Launching {subnet_count} replicas in {subnet_id} failed after launching "
+                f"{', '.join(instance_ids)}: {e}", instance_ids)
+        instance_ids.extend(new_instance.id for new_instance in new_instances)
+    return instance_ids
+
+
+# predict how long a migration wave takes and the parallelism to run it with: /plan-wave
+@app.post("/plan-wave")
+def plan_migration_wave(request: PlanRequest, http_request: Request):
+    ec2 = create_ec2_client(request.aws_access_key_id,
+                            request.aws_secret_access_key, request.region_name)
+    instances = describe_wave(ec2, request.instance_ids)
+    account_id = get_account_id(request.aws_access_key_id,
+                                request.aws_secret_access_key, request.region_name)
+    conn = open_queue()
+    try:
+        limits = get_account_limits(conn, account_id)
+    finally:
+        conn.close()
+    plan = plan_wave(
+        instances,
+        stage_throughput(),
+        snapshot_concurrency=request.snapshot_concurrency or limits['max_snapshots'],
+        copy_concurrency=request.copy_concurrency or limits['max_copies'],
+        max_parallelism=request.max_parallelism or min(max(1, len(instances)), limits['max_running'])
+    )
+    return compact_response(http_request, plan)
+
+
+# replicate a whole VPC into the destination account: /replicate-topology
+# returns the new VPC ID and the destination ID of every source resource. A VPC
+# already replicated to the account returns the earlier result ("reused": true)
+@app.post("/replicate-topology")
+def replicate_vpc_topology(request: TopologyRequest):
+    source_ec2, dest_ec2 = establish_connection(request)
+    dest_account_id = get_account_id(request.dest_aws_access_key_id,
+                                     request.dest_aws_secret_access_key, request.dest_region_name)
+    try:
+        return replicate_once(source_ec2, dest_ec2, request.vpc_id, dest_account_id,
+                              request.dest_region_name, request.workers, request.availability_zones)
+    except TopologyError as e:
+        raise HTTPException(status_code=502, detail={"error": str(e), "created": e.created})
+
+
+# refresh the local inventory index of the account: /refresh-inventory
+@app.post("/refresh-inventory")
+def refresh_inventory_index(request: InventoryRequest):
+    ec2 = create_ec2_client(request.aws_access_key_id,
+                            request.aws_secret_access_key, request.region_name)
+    account_id = get_account_id(request.aws_access_key_id,
+                                request.aws_secret_access_key, request.region_name)
+    conn = open_inventory()
+    try:
+        return refresh_inventory(conn, ec2, account_id, request.region_name, request.max_age)
+    finally:
+        conn.close()
+
+
+# search the local inventory index: /search?fields=instance_id,state,tags
+# this only reads the index, call /refresh-inventory first
+@app.post("/search")
+def search(request: InventorySearchRequest, http_request: Request):
+    conn = open_inventory()
+    try:
+        results = search_inventory(
+            conn,
+            resource_type=request.resource_type,
+            account_id=request.account_id,
+            region_name=request.region_name,
+            filters=request.filters,
+            tags=request.tags,
+            text=request.text,
+            page_token=request.page_token,
+            page_size=max(1, min(request.page_size, 1000))
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        conn.close()
+    return compact_response(http_request, results, "items")
+
+
+# queue a migration for the workers: /enqueue-migration
+# the job is keyed on the source account so its concurrency cap holds across all workers,
+# its cost for fair queuing is the number of volumes to snapshot and copy
+@app.post("/enqueue-migration")
+def enqueue_migration(request: MigrationRequest):
+    if request.priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Unknown priority {request.priority}")
+    validate_migration(request)
+    account_id = get_account_id(request.source_aws_access_key_id,
+                                request.source_aws_secret_access_key, request.source_region_name)
+    source_ec2 = create_ec2_client(request.source_aws_access_key_id,
+                                   request.source_aws_secret_access_key, request.source_region_name)
+    instance = source_ec2.describe_instances(
+        InstanceIds=[request.instance_id])['Reservations'][0]['Instances'][0]
+    cost = max(1, len([volume for volume in instance['BlockDeviceMappings'] if 'Ebs' in volume]))
+
+    conn = open_queue()
+    try:
+        job_id = enqueue_job(conn, account_id, request.instance_id, request.dict(),
+                             tenant=request.team, priority=request.priority, cost=cost)
+    except DuplicateJob as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    finally:
+        conn.close()
+    return {"job_id": job_id}
+
+
+# job status: /jobs/{job_id}
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str, http_request: Request):
+    conn = open_queue()
+    try:
+        job = get_job(conn, job_id)
+    finally:
+        conn.close()
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return compact_response(http_request, job)
+
+
+# list jobs: /jobs?state=queued&fields=job_id,state
+# or the status of a whole wave in one request: /jobs?ids=a,b,c&fields=job_id,state,error
+@app.get("/jobs")
+def jobs(http_request: Request, state: Optional[str] = None, limit: int = 100, ids: Optional[str] = None):
+    job_ids = [job_id for job_id in (ids or '').split(',') if job_id]
+    conn = open_queue()
+    try:
+        found = list_jobs(conn, state, max(limit, len(job_ids)), job_ids)
+        return compact_response(http_request, {"jobs": found}, "jobs")
+    finally:
+        conn.close()
+
+
+# set the concurrency cap of a source account: /account-limit
+@app.post("/account-limit")
+def account_limit(request: AccountLimitRequest):
+    conn = open_queue()
+    try:
+        set_account_limit(conn, request.account_id, request.max_running,
+                          request.max_snapshots, request.max_copies)
+    finally:
+        conn.close()
+    return request.dict()
+
+
+# set the fair share weight of a team: /tenant-weight
+# a team with weight 2 gets twice the migrations of a team with weight 1 when both have work queued
+@app.post("/tenant-weight")
+def tenant_weight(request: TenantWeightRequest):
+    if request.weight <= 0:
+        raise HTTPException(status_code=400, detail="Weight must be positive")
+    conn = open_queue()
+    try:
+        set_tenant_weight(conn, request.tenant, request.weight)
+    finally:
+        conn.close()
+    return request.dict()
+
+
+# run queued migrations in this process, AMBA_QUEUE_WORKERS threads per uvicorn worker
+def run_queued_migration(payload, job):
+    return run_migration(MigrationRequest(**payload), job)
+
+
+@app.on_event("startup")
+def start_queue_workers():
+    count = int(os.environ.get('AMBA_QUEUE_WORKERS', '2'))
+    if count > 0:
+        app.state.queue_stop = start_workers(run_queued_migration, count)
+
+
+@app.on_event("shutdown")
+def stop_queue_workers():
+    if hasattr(app.state, 'queue_stop'):
+        app.state.queue_stop.set()
+
+
 # TEST
 
 
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
+
+
+# health check for load balancers and container readiness probes: /health
+# with ?sdk=true the SDK is loaded first, so the first real request does not pay for it
+@app.get("/health")
+def health(sdk: bool = False):
+    if sdk and not aws.sdk_loaded():
+        aws.prewarm()
+    return {"status": "ok", "sdk_loaded": aws.sdk_loaded()}
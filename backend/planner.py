@@ -0,0 +1,322 @@
+import heapq
+import json
+import sys
+import time
+
+from work_queue import ACCOUNT_CONCURRENCY, ACCOUNT_COPIES, ACCOUNT_SNAPSHOTS, QUEUE_DB, connect
+
+
+# capacity planner for a migration wave: a discrete-event simulation of the
+# run_migration stages (snapshot -> copy -> AMI -> launch) for every instance,
+# using the per-GB throughput measured by earlier migrations and the caps the
+# work queue puts on a source account: running migrations (the parallelism) and
+# volumes snapshotting / copying at once, handed out like work_queue.acquire_slots.
+
+# GB per second and fixed seconds per volume, used until we have history
+DEFAULT_THROUGHPUT = {'snapshot': 0.08, 'copy': 0.05}
+STAGE_OVERHEAD = {'snapshot': 60, 'copy': 120, 'ami': 30, 'launch': 90}
+
+# parallelisms above this are simulated on a grid growing by GRID_STEP
+EXHAUSTIVE_PARALLELISM = 64
+GRID_STEP = 1.1
+
+# how many recent volumes the throughput is averaged over
+HISTORY_WINDOW = 200
+
+# one row per volume. (stage_history held one row per instance, with the wall
+# clock of all its volumes against their total size, and is no longer read)
+HISTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS volume_stage_history (
+    stage TEXT NOT NULL,
+    gigabytes REAL NOT NULL,
+    seconds REAL NOT NULL,
+    finished_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS volume_stage_history_stage ON volume_stage_history (stage, finished_at);
+'''
+
+
+def open_history(path=QUEUE_DB):
+    conn = connect(path)
+    conn.executescript(HISTORY_SCHEMA)
+    return conn
+
+
+# record how long a stage of a real migration took for one volume of the given size
+def record_stage(stage, gigabytes, seconds, path=QUEUE_DB):
+    conn = open_history(path)
+    try:
+        with conn:
+            conn.execute('INSERT INTO volume_stage_history (stage, gigabytes, seconds, finished_at) '
+                         'VALUES (?, ?, ?, ?)',
+                         (stage, gigabytes, seconds, time.time()))
+    finally:
+        conn.close()
+
+
+# GB per second of every stage over the last volumes, defaults where there is no history.
+# the fixed overhead is taken out of every sample since the simulation adds it back per volume
+def stage_throughput(path=QUEUE_DB):
+    throughput = dict(DEFAULT_THROUGHPUT)
+    conn = open_history(path)
+    try:
+        for stage in throughput:
+            gigabytes, seconds = conn.execute(
+                'SELECT SUM(gigabytes), SUM(MAX(seconds - ?, 1)) FROM (SELECT gigabytes, seconds '
+                'FROM volume_stage_history WHERE stage = ? ORDER BY finished_at DESC LIMIT ?)',
+                (STAGE_OVERHEAD[stage], stage, HISTORY_WINDOW)).fetchone()
+            if gigabytes and seconds:
+                throughput[stage] = gigabytes / seconds
+    finally:
+        conn.close()
+    return throughput
+
+
+# a pool of slots (migration workers, snapshot or copy concurrency)
+class Resource:
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = capacity
+        self.in_use = 0
+        self.peak = 0
+        self.waiting = []
+
+
+class Simulation:
+    def __init__(self, throughput, parallelism, snapshot_concurrency, copy_concurrency):
+        self.throughput = throughput
+        self.now = 0.0
+        self.events = []
+        self.sequence = 0
+        self.resources = {
+            'worker': Resource('worker', parallelism),
+            'snapshot': Resource('snapshot', snapshot_concurrency),
+            'copy': Resource('copy', copy_concurrency),
+        }
+        self.tasks = []
+
+    def schedule(self, delay, callback):
+        self.sequence += 1
+        heapq.heappush(self.events, (self.now + delay, self.sequence, callback))
+
+    def run(self):
+        while self.events:
+            self.now, _, callback = heapq.heappop(self.events)
+            callback()
+
+    # ask for count slots, callback(blocker) runs once we have them. Like the queue,
+    # requests are granted in turn and all at once: the first one waiting gets its
+    # slots when they fit (or the pool is idle, if it is bigger than the pool) and no
+    # request goes ahead of it. blocker is the task whose release let the request
+    # through, None if the slots were free
+    def acquire(self, name, callback, count=1):
+        resource = self.resources[name]
+        resource.waiting.append((count, callback))
+        self.grant(resource, None)
+
+    def release(self, name, task, count=1):
+        resource = self.resources[name]
+        resource.in_use -= count
+        self.grant(resource, task)
+
+    def grant(self, resource, blocker):
+        while resource.waiting:
+            count, callback = resource.waiting[0]
+            if resource.in_use and resource.in_use + count > resource.capacity:
+                break
+            resource.waiting.pop(0)
+            resource.in_use += count
+            resource.peak = max(resource.peak, resource.in_use)
+            callback(blocker)
+
+    # a timed piece of work, after is the task that had to finish before it could start
+    def task(self, instance_id, stage, duration, after, volume_id=None):
+        task = {
+            'id': len(self.tasks),
+            'instance_id': instance_id,
+            'stage': stage,
+            'volume_id': volume_id,
+            'start': self.now,
+            'end': self.now + duration,
+            'after': after['id'] if after else None,
+        }
+        self.tasks.append(task)
+        return task
+
+
+def volume_seconds(throughput, stage, size):
+    return STAGE_OVERHEAD[stage] + size / throughput[stage]
+
+
+# one instance: wait for a worker, snapshot all volumes, copy all volumes,
+# register the AMI and launch, the same order as run_migration. Each of the two
+# volume stages takes one slot per volume in a single request and holds them all
+# until its last volume is done, as run_migration does with stage_slots
+def migrate(sim, instance):
+    instance_id = instance['instance_id']
+    volumes = instance['volumes']
+
+    def with_worker(blocker):
+        queued = sim.task(instance_id, 'queued', 0, blocker)
+        volume_stage('snapshot', queued, after_snapshots)
+
+    def volume_stage(stage, previous, then):
+        pending = {'count': len(volumes), 'last': previous}
+        if not volumes:
+            then(previous)
+            return
+
+        def finished(task):
+            pending['count'] -= 1
+            if task['end'] >= pending['last']['end']:
+                pending['last'] = task
+            if pending['count'] == 0:
+                sim.release(stage, pending['last'], len(volumes))
+                then(pending['last'])
+
+        def start(blocker):
+            after = blocker if blocker and blocker['end'] > previous['end'] else previous
+            for volume in volumes:
+                duration = volume_seconds(sim.throughput, stage, volume['size'])
+                task = sim.task(instance_id, stage, duration, after, volume['volume_id'])
+                sim.schedule(duration, lambda task=task: finished(task))
+
+        sim.acquire(stage, start, len(volumes))
+
+    def after_snapshots(previous):
+        volume_stage('copy', previous, after_copies)
+
+    def after_copies(previous):
+        ami = sim.task(instance_id, 'ami', STAGE_OVERHEAD['ami'], previous)
+        sim.schedule(STAGE_OVERHEAD['ami'], lambda: launch(ami))
+
+    def launch(previous):
+        task = sim.task(instance_id, 'launch', STAGE_OVERHEAD['launch'], previous)
+        sim.schedule(STAGE_OVERHEAD['launch'], lambda: sim.release('worker', task))
+
+    sim.acquire('worker', with_worker)
+
+
+def simulate(instances, throughput, parallelism, snapshot_concurrency, copy_concurrency):
+    sim = Simulation(throughput, parallelism, snapshot_concurrency, copy_concurrency)
+    for instance in instances:
+        migrate(sim, instance)
+    sim.run()
+    return sim
+
+
+# walk back from the task that finished last through whatever held each task up
+def critical_path(tasks):
+    if not tasks:
+        return []
+    task = max(tasks, key=lambda t: (t['end'], t['id']))
+    path = []
+    while task is not None:
+        if task['stage'] != 'queued':
+            path.append(task)
+        task = tasks[task['after']] if task['after'] is not None else None
+    return list(reversed(path))
+
+
+# every parallelism up to EXHAUSTIVE_PARALLELISM, then a grid up to max_parallelism
+def parallelism_candidates(max_parallelism):
+    candidates = list(range(1, min(max_parallelism, EXHAUSTIVE_PARALLELISM) + 1))
+    parallelism = EXHAUSTIVE_PARALLELISM
+    while parallelism < max_parallelism:
+        parallelism = min(max_parallelism, max(parallelism + 1, int(parallelism * GRID_STEP)))
+        candidates.append(parallelism)
+    return candidates
+
+
+# the smallest parallelism (up to max_parallelism, by default the queue's cap on
+# running migrations) within tolerance of the best makespan. The makespan does not
+# always fall as parallelism grows (the in-turn slot queues can make a bigger pool
+# finish later), so every parallelism up to
+# EXHAUSTIVE_PARALLELISM is simulated, above it a grid growing by GRID_STEP and
+# every parallelism around the best grid point. The recommendation is always a
+# simulated point that meets the target
+def plan_wave(instances, throughput=None, snapshot_concurrency=ACCOUNT_SNAPSHOTS,
+              copy_concurrency=ACCOUNT_COPIES, max_parallelism=None, tolerance=0.05):
+    throughput = throughput or dict(DEFAULT_THROUGHPUT)
+    max_parallelism = max_parallelism or max(1, min(len(instances), ACCOUNT_CONCURRENCY))
+
+    makespans = {}
+
+    def makespan(parallelism):
+        if parallelism not in makespans:
+            sim = simulate(instances, throughput, parallelism, snapshot_concurrency, copy_concurrency)
+            makespans[parallelism] = max((t['end'] for t in sim.tasks), default=0)
+        return makespans[parallelism]
+
+    candidates = parallelism_candidates(max_parallelism)
+    for parallelism in candidates:
+        makespan(parallelism)
+    # the best grid point only approximates the best parallelism, simulate
+    # everything between its neighbours on the grid
+    best = candidates.index(min(candidates, key=makespan))
+    for parallelism in range(candidates[max(0, best - 1)], candidates[min(len(candidates) - 1, best + 1)] + 1):
+        makespan(parallelism)
+
+    target = min(makespans.values()) * (1 + tolerance)
+    recommended = min(p for p, value in makespans.items() if value <= target)
+    sim = simulate(instances, throughput, recommended, snapshot_concurrency, copy_concurrency)
+
+    timeline = {}
+    for task in sim.tasks:
+        if task['stage'] == 'queued':
+            continue
+        stages = timeline.setdefault(task['instance_id'], {})
+        stage = stages.setdefault(task['stage'], {'start': task['start'], 'end': task['end']})
+        stage['start'] = min(stage['start'], task['start'])
+        stage['end'] = max(stage['end'], task['end'])
+
+    return {
+        'predicted_seconds': makespans[recommended],
+        'throughput_gb_per_second': throughput,
+        'timeline': timeline,
+        'critical_path': [
+            {key: task[key] for key in ('instance_id', 'stage', 'volume_id', 'start', 'end')}
+            for task in critical_path(sim.tasks)
+        ],
+        'recommended': {
+            'parallelism': recommended,
+            'snapshot_concurrency': max(1, sim.resources['snapshot'].peak),
+            'copy_concurrency': max(1, sim.resources['copy'].peak),
+        },
+        # only the parallelisms the search simulated
+        'makespan_by_parallelism': dict(sorted(makespans.items())),
+    }
+
+
+# instances and their volume sizes from the source account
+def describe_wave(ec2, instance_ids=None):
+    kwargs = {'InstanceIds': instance_ids} if instance_ids else {}
+    instances = {}
+    for page in ec2.get_paginator('describe_instances').paginate(**kwargs):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                instances[instance['InstanceId']] = {'instance_id': instance['InstanceId'], 'volumes': []}
+
+    ids = list(instances)
+    for i in range(0, len(ids), 200):
+        for page in ec2.get_paginator('describe_volumes').paginate(
+                Filters=[{'Name': 'attachment.instance-id', 'Values': ids[i:i + 200]}]):
+            for volume in page['Volumes']:
+                for attachment in volume['Attachments']:
+                    if attachment['InstanceId'] in instances:
+                        instances[attachment['InstanceId']]['volumes'].append(
+                            {'volume_id': volume['VolumeId'], 'size': volume['Size']})
+    return list(instances.values())
+
+
+# python planner.py wave.json
+# wave.json: [{"instance_id": "i-...", "volumes": [{"volume_id": "vol-...", "size": 8}]}, ...]
+def main():
+    with open(sys.argv[1]) as file:
+        instances = json.load(file)
+    plan = plan_wave(instances, stage_throughput())
+    print(json.dumps(plan, indent=2))
+
+
+if __name__ == "__main__":
+    main()
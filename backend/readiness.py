@@ -0,0 +1,196 @@
+import socket
+import threading
+import time
+
+
+# post-launch readiness checks. One poller per destination account/region
+# watches every instance launched by the migrations running in this process and
+# checks them all with batched describe_instance_status calls. The interval
+# starts short, grows while nothing changes and drops back when something does.
+MIN_INTERVAL = 2
+MAX_INTERVAL = 15
+BACKOFF = 1.5
+
+# describe_instance_status takes at most 100 instance IDs per call
+BATCH_SIZE = 100
+
+PROBE_TIMEOUT = 3
+
+pollers = {}
+pollers_lock = threading.Lock()
+
+
+class ReadinessPoller:
+    def __init__(self, ec2):
+        self.ec2 = ec2
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # instance id -> {'state', 'ready', 'failed'}
+        self.status = {}
+        self.watchers = {}
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def watch(self, instance_ids):
+        with self.lock:
+            for instance_id in instance_ids:
+                self.watchers[instance_id] = self.watchers.get(instance_id, 0) + 1
+                self.status.setdefault(instance_id, {'state': 'pending', 'ready': False, 'failed': False})
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        # new instances should not wait for a backed off interval
+        self.wakeup.set()
+
+    def unwatch(self, instance_ids):
+        with self.lock:
+            for instance_id in instance_ids:
+                self.watchers[instance_id] -= 1
+                if self.watchers[instance_id] == 0:
+                    del self.watchers[instance_id]
+                    del self.status[instance_id]
+
+    def poll(self):
+        with self.lock:
+            pending = [instance_id for instance_id, status in self.status.items()
+                       if not status['ready'] and not status['failed']]
+        changed = False
+        for i in range(0, len(pending), BATCH_SIZE):
+            response = self.ec2.describe_instance_status(
+                InstanceIds=pending[i:i + BATCH_SIZE], IncludeAllInstances=True)
+            with self.lock:
+                for status in response['InstanceStatuses']:
+                    current = self.status.get(status['InstanceId'])
+                    if current is None:
+                        continue
+                    state = status['InstanceState']['Name']
+                    checks = (status['SystemStatus']['Status'], status['InstanceStatus']['Status'])
+                    ready = state == 'running' and checks == ('ok', 'ok')
+                    failed = state in ('shutting-down', 'terminated', 'stopped') or 'impaired' in checks
+                    if (state, ready, failed) != (current['state'], current['ready'], current['failed']):
+                        current.update(state=state, ready=ready, failed=failed)
+                        changed = True
+                if changed:
+                    self.changed.notify_all()
+        return changed
+
+    def run(self):
+        interval = MIN_INTERVAL
+        while True:
+            with self.lock:
+                if not self.watchers:
+                    self.thread = None
+                    return
+            try:
+                changed = self.poll()
+            except Exception as e:
+                print(f"Error polling instance status: {e}")
+                changed = False
+            interval = MIN_INTERVAL if changed else min(interval * BACKOFF, MAX_INTERVAL)
+            if self.wakeup.wait(interval):
+                self.wakeup.clear()
+                interval = MIN_INTERVAL
+
+    # block until every instance is ready or failed, or the timeout runs out.
+    # returns the seconds each instance took to become ready (None if it did not)
+    def wait(self, instance_ids, timeout, started):
+        ready_at = {}
+        deadline = started + timeout
+        with self.lock:
+            while True:
+                for instance_id in instance_ids:
+                    if instance_id not in ready_at and self.status[instance_id]['ready']:
+                        ready_at[instance_id] = time.time() - started
+                done = all(self.status[i]['ready'] or self.status[i]['failed'] for i in instance_ids)
+                remaining = deadline - time.time()
+                if done or remaining <= 0:
+                    break
+                self.changed.wait(remaining)
+            return {
+                instance_id: {
+                    'state': self.status[instance_id]['state'],
+                    'status_checks_passed': self.status[instance_id]['ready'],
+                    'seconds_to_ready': ready_at.get(instance_id),
+                }
+                for instance_id in instance_ids
+            }
+
+
+# the shared poller of a destination account/region
+def get_poller(key, ec2):
+    with pollers_lock:
+        if key not in pollers:
+            pollers[key] = ReadinessPoller(ec2)
+        return pollers[key]
+
+
+def probe_port(address, port, timeout=PROBE_TIMEOUT):
+    try:
+        with socket.create_connection((address, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+# retry the TCP probe of every port until it answers or the deadline passes,
+# returns the open ports of every instance and when the last one opened
+def probe_instances(ec2, instance_ids, ports, deadline):
+    addresses = {}
+    for i in range(0, len(instance_ids), BATCH_SIZE):
+        response = ec2.describe_instances(InstanceIds=instance_ids[i:i + BATCH_SIZE])
+        for reservation in response['Reservations']:
+            for instance in reservation['Instances']:
+                addresses[instance['InstanceId']] = (
+                    instance.get('PublicIpAddress') or instance.get('PrivateIpAddress'))
+
+    results = {instance_id: {'ports': {port: False for port in ports}, 'open_at': None}
+               for instance_id in instance_ids}
+    while True:
+        for instance_id, address in addresses.items():
+            result = results[instance_id]
+            if not address or result['open_at']:
+                continue
+            for port in ports:
+                if not result['ports'][port]:
+                    result['ports'][port] = probe_port(address, port)
+            if all(result['ports'].values()):
+                result['open_at'] = time.time()
+        if all(result['open_at'] for result in results.values()) or time.time() >= deadline:
+            return results
+        time.sleep(MIN_INTERVAL)
+
+
+# the launched instances did not all pass their status checks (or open their ports)
+# in time, result is the migration result with the readiness of every instance
+class InstancesNotReady(Exception):
+    def __init__(self, message, result):
+        super().__init__(message)
+        self.result = result
+
+
+# instances of a verify_instances result that failed their checks or left a port closed
+def not_ready(readiness):
+    return [instance_id for instance_id, state in readiness.items()
+            if not state['status_checks_passed'] or not all(state.get('reachable', {}).values())]
+
+
+# the verification stage: wait for status checks on all the instances through
+# the shared poller, then probe the ports. started is when the instances were launched
+def verify_instances(key, ec2, instance_ids, ports=(), timeout=900, started=None):
+    started = started or time.time()
+    poller = get_poller(key, ec2)
+    poller.watch(instance_ids)
+    try:
+        readiness = poller.wait(instance_ids, timeout, started)
+    finally:
+        poller.unwatch(instance_ids)
+
+    if ports:
+        ready = [i for i in instance_ids if readiness[i]['status_checks_passed']]
+        probes = probe_instances(ec2, ready, ports, started + timeout) if ready else {}
+        for instance_id in instance_ids:
+            probe = probes.get(instance_id, {'ports': {port: False for port in ports}, 'open_at': None})
+            readiness[instance_id]['reachable'] = probe['ports']
+            readiness[instance_id]['seconds_to_ready'] = (
+                probe['open_at'] - started if probe['open_at'] else None)
+    return readiness
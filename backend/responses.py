@@ -0,0 +1,87 @@
+import gzip
+import json
+
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# compact responses for the list, inventory and job endpoints. The payload is
+# encoded straight to bytes (orjson when installed) instead of going through
+# FastAPI's jsonable_encoder, optionally cut down to ?fields=a,b,c and compressed
+# with brotli or gzip, whichever the client accepts.
+
+# below this size compression costs more than it saves
+MIN_COMPRESS_SIZE = 1024
+# fast settings, these responses are built per request and never cached
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def encode(payload):
+    if orjson is not None:
+        return orjson.dumps(payload, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, separators=(',', ':'), default=str).encode()
+
+
+# keep only the requested keys of every item in list_key (or of the payload itself)
+def project(payload, fields, list_key=None):
+    if not fields:
+        return payload
+    keep = {field.strip() for field in fields.split(',') if field.strip()}
+    if list_key is None:
+        return {key: value for key, value in payload.items() if key in keep}
+    projected = dict(payload)
+    projected[list_key] = [
+        {key: value for key, value in item.items() if key in keep} if isinstance(item, dict) else item
+        for item in payload[list_key]
+    ]
+    return projected
+
+
+# the encoding with the highest q the client accepts, br before gzip on a tie and
+# None for identity (when nothing is acceptable, or identity has the higher q)
+def negotiate(accept_encoding):
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+    wildcard = accepted.get('*', 0)
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    best = max(encodings, key=lambda name: accepted.get(name, wildcard))
+    quality = accepted.get(best, wildcard)
+    if quality <= 0 or accepted.get('identity', 0) > quality:
+        return None
+    return best
+
+
+def compact_response(http_request, payload, list_key=None):
+    fields = http_request.query_params.get('fields')
+    body = encode(project(payload, fields, list_key))
+    headers = {'Vary': 'Accept-Encoding'}
+
+    encoding = negotiate(http_request.headers.get('accept-encoding')) \
+        if len(body) >= MIN_COMPRESS_SIZE else None
+    if encoding == 'br':
+        body = brotli.compress(body, quality=BROTLI_QUALITY)
+        headers['Content-Encoding'] = 'br'
+    elif encoding == 'gzip':
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(content=body, media_type='application/json', headers=headers)
@@ -0,0 +1,516 @@
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from work_queue import QUEUE_DB, connect
+
+
+# network topology replication: read a source VPC with its subnets, route
+# tables, internet and NAT gateways and security groups in one pass, build a
+# dependency graph of the creates needed to rebuild it in the destination
+# account and run it, independent creates in parallel and dependent ones in order.
+# What cannot be replicated is skipped and reported: routes to targets we do not
+# replicate (peering, transit gateways, endpoints, instances, network interfaces),
+# IPv6 and prefix list routes, subnets in Local Zones, and security group rules
+# that reference prefix lists or groups outside the VPC.
+#
+# replicate_once replicates a source VPC only once per destination account and
+# region: every migration of a wave from the same VPC reuses the result, and a
+# failed replication resumes from the resources it already created.
+
+WORKERS = 16
+
+# a replication that has not recorded progress for this long is taken over
+REPLICATION_STALE_SECONDS = 900
+REPLICATION_POLL_INTERVAL = 5
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS topology_replications (
+    dest_account_id TEXT NOT NULL,
+    dest_region TEXT NOT NULL,
+    source_vpc_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    created TEXT NOT NULL,
+    skipped TEXT,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (dest_account_id, dest_region, source_vpc_id)
+);
+'''
+
+
+class TopologyError(Exception):
+    def __init__(self, message, created):
+        super().__init__(message)
+        self.created = created
+
+
+# read everything about the VPC with concurrent describe calls
+def read_topology(ec2, vpc_id):
+    vpc_filter = [{'Name': 'vpc-id', 'Values': [vpc_id]}]
+    calls = {
+        'vpc': lambda: ec2.describe_vpcs(VpcIds=[vpc_id])['Vpcs'][0],
+        'subnets': lambda: ec2.describe_subnets(Filters=vpc_filter)['Subnets'],
+        'route_tables': lambda: ec2.describe_route_tables(Filters=vpc_filter)['RouteTables'],
+        'internet_gateways': lambda: ec2.describe_internet_gateways(Filters=[
+            {'Name': 'attachment.vpc-id', 'Values': [vpc_id]}])['InternetGateways'],
+        'nat_gateways': lambda: ec2.describe_nat_gateways(Filters=vpc_filter + [
+            {'Name': 'state', 'Values': ['available']}])['NatGateways'],
+        'security_groups': lambda: ec2.describe_security_groups(Filters=vpc_filter)['SecurityGroups'],
+        'dns_support': lambda: ec2.describe_vpc_attribute(
+            VpcId=vpc_id, Attribute='enableDnsSupport')['EnableDnsSupport']['Value'],
+        'dns_hostnames': lambda: ec2.describe_vpc_attribute(
+            VpcId=vpc_id, Attribute='enableDnsHostnames')['EnableDnsHostnames']['Value'],
+        'availability_zones': lambda: availability_zones(ec2),
+    }
+    with ThreadPoolExecutor(max_workers=len(calls)) as pool:
+        futures = {name: pool.submit(call) for name, call in calls.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+# tags to carry over, aws: tags are reserved
+def tag_specifications(resource_type, tags):
+    tags = [tag for tag in tags or [] if not tag['Key'].startswith('aws:')]
+    return [{'ResourceType': resource_type, 'Tags': tags}] if tags else []
+
+
+# the regular availability zones of the region (no Local or Wavelength Zones)
+def availability_zones(ec2):
+    zones = ec2.describe_availability_zones(Filters=[
+        {'Name': 'zone-type', 'Values': ['availability-zone']},
+        {'Name': 'state', 'Values': ['available']}
+    ])['AvailabilityZones']
+    return sorted(zones, key=lambda zone: zone['ZoneName'])
+
+
+# source zone name -> destination zone name. Zone letters are assigned per account,
+# so within one region zones are matched by zone ID (the same physical zone in every
+# account) and across regions by their position in the region's zone list.
+# explicit ({"us-east-1a": "eu-west-1b"}) wins, zones missing here cannot be replicated
+def map_availability_zones(source_zones, dest_zones, same_region, explicit=None):
+    dest_by_id = {zone['ZoneId']: zone['ZoneName'] for zone in dest_zones}
+    zone_map = {}
+    for position, zone in enumerate(source_zones):
+        if same_region and zone['ZoneId'] in dest_by_id:
+            zone_map[zone['ZoneName']] = dest_by_id[zone['ZoneId']]
+        elif not same_region and dest_zones:
+            zone_map[zone['ZoneName']] = dest_zones[position % len(dest_zones)]['ZoneName']
+    zone_map.update(explicit or {})
+    return zone_map
+
+
+# a node of the creation graph: run(created) gets the dest IDs of the nodes
+# it depends on through created and returns the dest ID of what it made
+class Node:
+    def __init__(self, key, deps, run):
+        self.key = key
+        self.deps = set(deps)
+        self.run = run
+
+
+# run the nodes, each once its dependencies are done. created holds nodes already
+# done by an earlier run, on_created(created) is called after every new one
+def run_graph(nodes, workers=WORKERS, created=None, on_created=None):
+    nodes = {node.key: node for node in nodes}
+    missing = {dep for node in nodes.values() for dep in node.deps if dep not in nodes}
+    if missing:
+        raise ValueError(f"Unknown dependencies {sorted(missing)}")
+
+    dependents = {key: [] for key in nodes}
+    waiting_on = {key: set(node.deps) for key, node in nodes.items()}
+    for key, node in nodes.items():
+        for dep in node.deps:
+            dependents[dep].append(key)
+
+    created = {key: value for key, value in (created or {}).items() if key in nodes}
+    for key in created:
+        for dependent in dependents[key]:
+            waiting_on[dependent].discard(key)
+
+    failure = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {pool.submit(nodes[key].run, created): key
+                   for key, deps in waiting_on.items() if not deps and key not in created}
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                key = running.pop(future)
+                try:
+                    created[key] = future.result()
+                except Exception as e:
+                    failure = failure or (key, e)
+                    continue
+                if on_created:
+                    on_created(created)
+                if failure:
+                    continue
+                for dependent in dependents[key]:
+                    waiting_on[dependent].discard(key)
+                    if not waiting_on[dependent] and dependent not in created:
+                        running[pool.submit(nodes[dependent].run, created)] = dependent
+
+    if failure:
+        raise TopologyError(f"Creating {failure[0]} failed: {failure[1]}", created)
+    if len(created) != len(nodes):
+        raise TopologyError('The topology has a dependency cycle', created)
+    return created
+
+
+def describe_permission(group_id, direction, permission):
+    ports = f"{permission.get('FromPort')}-{permission.get('ToPort')}" if 'FromPort' in permission else 'all'
+    return f"{group_id} {direction} {permission['IpProtocol']} {ports}"
+
+
+# security group rules that can be replicated: references to groups outside the
+# VPC and prefix lists are taken out and reported in skipped
+def split_permissions(group_id, direction, permissions, group_ids, skipped):
+    kept = []
+    for permission in permissions:
+        permission = dict(permission)
+        pairs = [{'GroupId': pair['GroupId']} for pair in permission.get('UserIdGroupPairs', [])
+                 if pair.get('GroupId') in group_ids]
+        if len(pairs) != len(permission.get('UserIdGroupPairs', [])):
+            skipped.append({'resource': describe_permission(group_id, direction, permission),
+                            'reason': 'references a security group outside the VPC'})
+        if permission.get('PrefixListIds'):
+            skipped.append({'resource': describe_permission(group_id, direction, permission),
+                            'reason': 'references a prefix list'})
+        permission['UserIdGroupPairs'] = pairs
+        permission['PrefixListIds'] = []
+        if any(permission.get(key) for key in ('IpRanges', 'Ipv6Ranges', 'UserIdGroupPairs')):
+            kept.append(permission)
+    return kept
+
+
+# the same rules with the groups they reference mapped to the destination
+def map_permissions(permissions, created):
+    return [dict(permission, UserIdGroupPairs=[{'GroupId': created[f"sg:{pair['GroupId']}"]}
+                                               for pair in permission['UserIdGroupPairs']])
+            for permission in permissions]
+
+
+def is_allow_all(permission):
+    return permission.get('IpProtocol') == '-1' and \
+        [r.get('CidrIp') for r in permission.get('IpRanges', [])] == ['0.0.0.0/0'] and \
+        not permission.get('UserIdGroupPairs') and not permission.get('PrefixListIds')
+
+
+# the rules every default group starts with: all traffic from itself, all traffic out
+def is_default_rule(group_id, direction, permission):
+    if direction == 'egress':
+        return is_allow_all(permission) and not permission.get('Ipv6Ranges')
+    return permission.get('IpProtocol') == '-1' and not permission.get('IpRanges') and \
+        not permission.get('Ipv6Ranges') and not permission.get('PrefixListIds') and \
+        [pair.get('GroupId') for pair in permission.get('UserIdGroupPairs', [])] == [group_id]
+
+
+# every create needed to rebuild the topology in the destination, and the
+# source resources that are left out
+def build_graph(topology, dest_ec2, zone_map):
+    source_vpc = topology['vpc']
+    nodes = []
+    skipped = []
+
+    def add(key, deps, run):
+        nodes.append(Node(key, deps, run))
+
+    # the VPC and its secondary CIDR blocks
+    def create_vpc(created):
+        return dest_ec2.create_vpc(
+            CidrBlock=source_vpc['CidrBlock'],
+            TagSpecifications=tag_specifications('vpc', source_vpc.get('Tags'))
+        )['Vpc']['VpcId']
+    add('vpc', [], create_vpc)
+
+    for attribute, enabled in (('EnableDnsSupport', topology['dns_support']),
+                               ('EnableDnsHostnames', topology['dns_hostnames'])):
+        def set_attribute(created, attribute=attribute, enabled=enabled):
+            dest_ec2.modify_vpc_attribute(VpcId=created['vpc'], **{attribute: {'Value': enabled}})
+            return created['vpc']
+        # hostnames need DNS support turned on first
+        add(f"vpc-attribute:{attribute}",
+            ['vpc'] + (['vpc-attribute:EnableDnsSupport'] if attribute == 'EnableDnsHostnames' else []),
+            set_attribute)
+
+    cidr_nodes = []
+    for association in source_vpc.get('CidrBlockAssociationSet', []):
+        if association['CidrBlock'] == source_vpc['CidrBlock'] or \
+                association['CidrBlockState']['State'] != 'associated':
+            continue
+        key = f"cidr:{association['CidrBlock']}"
+        cidr_nodes.append(key)
+        add(key, ['vpc'], lambda created, cidr=association['CidrBlock']: dest_ec2.associate_vpc_cidr_block(
+            VpcId=created['vpc'], CidrBlock=cidr)['CidrBlockAssociation']['AssociationId'])
+
+    # internet gateways: the create does not need the VPC, only the attach does
+    for igw in topology['internet_gateways']:
+        igw_id = igw['InternetGatewayId']
+        add(f"igw:{igw_id}", [], lambda created, igw=igw: dest_ec2.create_internet_gateway(
+            TagSpecifications=tag_specifications('internet-gateway', igw.get('Tags'))
+        )['InternetGateway']['InternetGatewayId'])
+
+        def attach(created, igw_id=igw_id):
+            dest_ec2.attach_internet_gateway(InternetGatewayId=created[f"igw:{igw_id}"], VpcId=created['vpc'])
+            return created[f"igw:{igw_id}"]
+        add(f"igw-attach:{igw_id}", ['vpc', f"igw:{igw_id}"], attach)
+
+    # subnets, in the mapped availability zone
+    subnets = []
+    for subnet in topology['subnets']:
+        if subnet['AvailabilityZone'] not in zone_map:
+            skipped.append({'resource': subnet['SubnetId'],
+                            'reason': f"no destination zone for {subnet['AvailabilityZone']}"})
+        else:
+            subnets.append(subnet)
+
+    for subnet in subnets:
+        subnet_id = subnet['SubnetId']
+
+        def create_subnet(created, subnet=subnet):
+            return dest_ec2.create_subnet(
+                VpcId=created['vpc'],
+                CidrBlock=subnet['CidrBlock'],
+                AvailabilityZone=zone_map[subnet['AvailabilityZone']],
+                TagSpecifications=tag_specifications('subnet', subnet.get('Tags'))
+            )['Subnet']['SubnetId']
+        add(f"subnet:{subnet_id}", ['vpc'] + cidr_nodes, create_subnet)
+
+        if subnet.get('MapPublicIpOnLaunch'):
+            def map_public_ip(created, subnet_id=subnet_id):
+                dest_ec2.modify_subnet_attribute(
+                    SubnetId=created[f"subnet:{subnet_id}"], MapPublicIpOnLaunch={'Value': True})
+                return created[f"subnet:{subnet_id}"]
+            add(f"subnet-public-ip:{subnet_id}", [f"subnet:{subnet_id}"], map_public_ip)
+
+    # NAT gateways, public ones need an elastic IP and the internet gateway attached
+    igw_attach_nodes = [f"igw-attach:{igw['InternetGatewayId']}" for igw in topology['internet_gateways']]
+    subnet_ids = {subnet['SubnetId'] for subnet in subnets}
+    for nat in topology['nat_gateways']:
+        nat_id = nat['NatGatewayId']
+        if nat['SubnetId'] not in subnet_ids:
+            skipped.append({'resource': nat_id, 'reason': 'subnet not found'})
+            continue
+        public = nat.get('ConnectivityType', 'public') == 'public'
+        deps = [f"subnet:{nat['SubnetId']}"]
+        if public:
+            add(f"eip:{nat_id}", [], lambda created: dest_ec2.allocate_address(Domain='vpc')['AllocationId'])
+            deps += [f"eip:{nat_id}"] + igw_attach_nodes
+
+        def create_nat(created, nat=nat, public=public):
+            kwargs = {
+                'SubnetId': created[f"subnet:{nat['SubnetId']}"],
+                'ConnectivityType': 'public' if public else 'private',
+                'TagSpecifications': tag_specifications('natgateway', nat.get('Tags')),
+            }
+            if public:
+                kwargs['AllocationId'] = created[f"eip:{nat['NatGatewayId']}"]
+            nat_gateway_id = dest_ec2.create_nat_gateway(**kwargs)['NatGateway']['NatGatewayId']
+            # routes can only point at an available NAT gateway
+            dest_ec2.get_waiter('nat_gateway_available').wait(NatGatewayIds=[nat_gateway_id])
+            return nat_gateway_id
+        add(f"nat:{nat_id}", deps, create_nat)
+
+    # route tables, routes and subnet associations
+    igw_ids = {igw['InternetGatewayId'] for igw in topology['internet_gateways']}
+    nat_ids = {f"nat:{nat['NatGatewayId']}" for nat in topology['nat_gateways'] if nat['SubnetId'] in subnet_ids}
+    for route_table in topology['route_tables']:
+        rtb_id = route_table['RouteTableId']
+        main = any(association.get('Main') for association in route_table.get('Associations', []))
+
+        if main:
+            # the destination VPC already has a main route table
+            def main_route_table(created):
+                return dest_ec2.describe_route_tables(Filters=[
+                    {'Name': 'vpc-id', 'Values': [created['vpc']]},
+                    {'Name': 'association.main', 'Values': ['true']}
+                ])['RouteTables'][0]['RouteTableId']
+            add(f"rtb:{rtb_id}", ['vpc'], main_route_table)
+        else:
+            add(f"rtb:{rtb_id}", ['vpc'], lambda created, route_table=route_table: dest_ec2.create_route_table(
+                VpcId=created['vpc'],
+                TagSpecifications=tag_specifications('route-table', route_table.get('Tags'))
+            )['RouteTable']['RouteTableId'])
+
+        for route in route_table.get('Routes', []):
+            if route.get('GatewayId') == 'local' or route.get('Origin') != 'CreateRoute':
+                continue
+            destination = route.get('DestinationCidrBlock')
+            if not destination:
+                # the new VPC has no IPv6 block, and prefix lists are per account
+                skipped.append({'resource': f"{rtb_id} {route.get('DestinationIpv6CidrBlock') or route.get('DestinationPrefixListId')}",
+                                'reason': 'IPv6 and prefix list routes are not replicated'})
+                continue
+            destination_key = 'DestinationCidrBlock'
+            if route.get('GatewayId') in igw_ids:
+                target_node, target_key = f"igw-attach:{route['GatewayId']}", 'GatewayId'
+            elif f"nat:{route.get('NatGatewayId')}" in nat_ids:
+                target_node, target_key = f"nat:{route['NatGatewayId']}", 'NatGatewayId'
+            else:
+                skipped.append({'resource': f"{rtb_id} {destination}", 'reason': 'route target not replicated'})
+                continue
+
+            def create_route(created, rtb_id=rtb_id, destination_key=destination_key,
+                             destination=destination, target_node=target_node, target_key=target_key):
+                dest_ec2.create_route(**{
+                    'RouteTableId': created[f"rtb:{rtb_id}"],
+                    destination_key: destination,
+                    target_key: created[target_node],
+                })
+                return created[f"rtb:{rtb_id}"]
+            add(f"route:{rtb_id}:{destination}", [f"rtb:{rtb_id}", target_node], create_route)
+
+        for association in route_table.get('Associations', []):
+            if association.get('Main') or association.get('SubnetId') not in subnet_ids:
+                continue
+
+            def associate(created, rtb_id=rtb_id, subnet_id=association['SubnetId']):
+                return dest_ec2.associate_route_table(
+                    RouteTableId=created[f"rtb:{rtb_id}"], SubnetId=created[f"subnet:{subnet_id}"]
+                )['AssociationId']
+            add(f"rtb-assoc:{rtb_id}:{association['SubnetId']}",
+                [f"rtb:{rtb_id}", f"subnet:{association['SubnetId']}"], associate)
+
+    # security groups first, their rules once every group they reference exists
+    group_ids = {sg['GroupId'] for sg in topology['security_groups']}
+    for sg in topology['security_groups']:
+        group_id = sg['GroupId']
+        if sg['GroupName'] == 'default':
+            def default_group(created):
+                return dest_ec2.describe_security_groups(Filters=[
+                    {'Name': 'vpc-id', 'Values': [created['vpc']]},
+                    {'Name': 'group-name', 'Values': ['default']}
+                ])['SecurityGroups'][0]['GroupId']
+            add(f"sg:{group_id}", ['vpc'], default_group)
+        else:
+            add(f"sg:{group_id}", ['vpc'], lambda created, sg=sg: dest_ec2.create_security_group(
+                GroupName=sg['GroupName'],
+                Description=sg['Description'],
+                VpcId=created['vpc'],
+                TagSpecifications=tag_specifications('security-group', sg.get('Tags'))
+            )['GroupId'])
+
+    for sg in topology['security_groups']:
+        group_id = sg['GroupId']
+        if sg['GroupName'] == 'default':
+            # the new default group keeps its own rules, anything added to the source one is reported
+            for direction, key in (('ingress', 'IpPermissions'), ('egress', 'IpPermissionsEgress')):
+                for permission in sg.get(key, []):
+                    if not is_default_rule(group_id, direction, permission):
+                        skipped.append({'resource': describe_permission(group_id, direction, permission),
+                                        'reason': 'custom rule on the default security group'})
+            continue
+
+        ingress = split_permissions(group_id, 'ingress', sg.get('IpPermissions', []), group_ids, skipped)
+        egress = sg.get('IpPermissionsEgress', [])
+        # new groups allow all egress, only touch egress if the source differs
+        default_egress = len(egress) == 1 and is_allow_all(egress[0])
+        egress = [] if default_egress else split_permissions(group_id, 'egress', egress, group_ids, skipped)
+        referenced = {pair['GroupId'] for permission in ingress + egress
+                      for pair in permission['UserIdGroupPairs']}
+
+        def create_rules(created, group_id=group_id, ingress=ingress, egress=egress,
+                         default_egress=default_egress):
+            new_group_id = created[f"sg:{group_id}"]
+            try:
+                if ingress:
+                    dest_ec2.authorize_security_group_ingress(
+                        GroupId=new_group_id, IpPermissions=map_permissions(ingress, created))
+                if not default_egress:
+                    dest_ec2.revoke_security_group_egress(GroupId=new_group_id, IpPermissions=[{
+                        'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}])
+                    if egress:
+                        dest_ec2.authorize_security_group_egress(
+                            GroupId=new_group_id, IpPermissions=map_permissions(egress, created))
+            except Exception as e:
+                # a resumed replication finds the rules of its earlier run
+                if 'InvalidPermission.Duplicate' not in str(e):
+                    raise e
+            return new_group_id
+        add(f"sg-rules:{group_id}", [f"sg:{group_id}"] + [f"sg:{ref}" for ref in referenced], create_rules)
+
+    return nodes, skipped
+
+
+# replicate the source VPC into the destination account, returns the dest ID of
+# every source resource (keys like "subnet:subnet-123", "sg:sg-456", "vpc").
+# created resumes a failed replication, on_created(created) sees every new resource
+def replicate_topology(source_ec2, dest_ec2, vpc_id, dest_region, workers=WORKERS,
+                       zones=None, created=None, on_created=None):
+    started = time.time()
+    topology = read_topology(source_ec2, vpc_id)
+    zone_map = map_availability_zones(
+        topology['availability_zones'], availability_zones(dest_ec2),
+        source_ec2.meta.region_name == dest_region, zones)
+    nodes, skipped = build_graph(topology, dest_ec2, zone_map)
+    created = run_graph(nodes, workers, created, on_created)
+    return {
+        'vpc_id': created['vpc'],
+        'created': created,
+        'skipped': skipped,
+        'operations': len(nodes),
+        'seconds': time.time() - started,
+    }
+
+
+def open_replications(path=QUEUE_DB):
+    conn = connect(path, isolation_level=None)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+# replicate_topology once per (destination account, region, source VPC). The first
+# caller claims the replication, concurrent callers wait for it and later ones get
+# the recorded result. A failed replication keeps what it created and the next
+# caller resumes from there instead of creating a second VPC
+def replicate_once(source_ec2, dest_ec2, vpc_id, dest_account_id, dest_region, workers=WORKERS,
+                   zones=None, path=QUEUE_DB):
+    key = (dest_account_id, dest_region, vpc_id)
+    conn = open_replications(path)
+    try:
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT state, created, skipped, updated_at FROM topology_replications '
+                'WHERE dest_account_id = ? AND dest_region = ? AND source_vpc_id = ?', key).fetchone()
+            if row and row[0] == 'done':
+                conn.execute('COMMIT')
+                created = json.loads(row[1])
+                return {'vpc_id': created['vpc'], 'created': created,
+                        'skipped': json.loads(row[2]), 'reused': True}
+            if row and row[0] == 'running' and row[3] > time.time() - REPLICATION_STALE_SECONDS:
+                conn.execute('COMMIT')
+                time.sleep(REPLICATION_POLL_INTERVAL)
+                continue
+            previous = json.loads(row[1]) if row else {}
+            conn.execute(
+                'INSERT INTO topology_replications '
+                '(dest_account_id, dest_region, source_vpc_id, state, created, updated_at) '
+                "VALUES (?, ?, ?, 'running', ?, ?) "
+                "ON CONFLICT (dest_account_id, dest_region, source_vpc_id) DO UPDATE SET "
+                "state = 'running', error = NULL, updated_at = excluded.updated_at",
+                key + (json.dumps(previous), time.time()))
+            conn.execute('COMMIT')
+            break
+
+        latest = dict(previous)
+
+        def save(state, created, skipped=None, error=None):
+            latest.update(created)
+            conn.execute(
+                'UPDATE topology_replications SET state = ?, created = ?, skipped = ?, error = ?, updated_at = ? '
+                'WHERE dest_account_id = ? AND dest_region = ? AND source_vpc_id = ?',
+                (state, json.dumps(created), json.dumps(skipped), error, time.time()) + key)
+
+        try:
+            result = replicate_topology(source_ec2, dest_ec2, vpc_id, dest_region, workers, zones,
+                                        previous, lambda created: save('running', created))
+        except TopologyError as e:
+            save('failed', e.created, error=str(e))
+            raise
+        except Exception as e:
+            save('failed', latest, error=str(e))
+            raise
+        save('done', result['created'], result['skipped'])
+        return dict(result, reused=False)
+    finally:
+        conn.close()
@@ -0,0 +1,538 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+try:
+    from cryptography.fernet import Fernet
+except ImportError:
+    Fernet = None
+
+# migration work queue shared by every uvicorn worker on one host. The database
+# runs in WAL mode, which needs shared memory between the processes, so it must
+# live on a local disk and cannot be shared between hosts over a network filesystem.
+# Jobs are claimed with a lease that the worker keeps alive with heartbeats; a job
+# whose lease runs out (the worker died) goes back to the queue. A retried job
+# resumes from the steps its earlier attempts recorded with save_progress.
+QUEUE_DB = os.environ.get('AMBA_QUEUE_DB', 'queue.db')
+
+# seconds a claim stays valid without a heartbeat
+LEASE_SECONDS = int(os.environ.get('AMBA_LEASE_SECONDS', '60'))
+
+# migrations that may run at the same time for one source account, across all workers
+ACCOUNT_CONCURRENCY = int(os.environ.get('AMBA_ACCOUNT_CONCURRENCY', '4'))
+
+# volumes one source account may have snapshotting / copying at the same time
+ACCOUNT_SNAPSHOTS = int(os.environ.get('AMBA_ACCOUNT_SNAPSHOTS', '20'))
+ACCOUNT_COPIES = int(os.environ.get('AMBA_ACCOUNT_COPIES', '20'))
+
+# priority classes, a queued cutover always goes before any rehearsal
+PRIORITIES = {'cutover': 0, 'rehearsal': 1}
+
+# seconds between two tries to get a snapshot or copy slot
+SLOT_POLL_INTERVAL = 5
+
+MAX_ATTEMPTS = 3
+
+# job payloads hold the AWS credentials of the migration. With AMBA_QUEUE_KEY set to a
+# Fernet key (needs the cryptography package) they are stored encrypted, without it
+# they are plain JSON and only the permissions of the queue file protect them
+QUEUE_KEY = os.environ.get('AMBA_QUEUE_KEY')
+if QUEUE_KEY and Fernet is None:
+    raise RuntimeError('AMBA_QUEUE_KEY is set but the cryptography package is not installed')
+PAYLOAD_CIPHER = Fernet(QUEUE_KEY) if QUEUE_KEY else None
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    account_id TEXT NOT NULL,
+    instance_id TEXT NOT NULL,
+    tenant TEXT NOT NULL DEFAULT '',
+    priority INTEGER NOT NULL DEFAULT 1,
+    cost REAL NOT NULL DEFAULT 1,
+    virtual_start REAL NOT NULL DEFAULT 0,
+    payload TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker_id TEXT,
+    lease_expires_at REAL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    progress TEXT,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at);
+CREATE INDEX IF NOT EXISTS jobs_account_state ON jobs (account_id, state);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_instance ON jobs (account_id, instance_id)
+    WHERE state IN ('queued', 'running');
+
+CREATE TABLE IF NOT EXISTS account_limits (
+    account_id TEXT PRIMARY KEY,
+    max_running INTEGER NOT NULL,
+    max_snapshots INTEGER,
+    max_copies INTEGER
+);
+
+-- weighted fair queuing across tenants (teams, or source accounts)
+CREATE TABLE IF NOT EXISTS tenants (
+    tenant TEXT PRIMARY KEY,
+    weight REAL NOT NULL DEFAULT 1,
+    virtual_finish REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS scheduler (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    virtual_time REAL NOT NULL
+);
+INSERT OR IGNORE INTO scheduler (id, virtual_time) VALUES (1, 0);
+
+-- snapshot and copy slots held by running jobs, per source account
+CREATE TABLE IF NOT EXISTS stage_slots (
+    account_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    lease_expires_at REAL NOT NULL,
+    PRIMARY KEY (job_id, kind)
+);
+CREATE INDEX IF NOT EXISTS stage_slots_account ON stage_slots (account_id, kind);
+
+-- jobs waiting for slots, granted strictly in turn so a big job is not starved
+CREATE TABLE IF NOT EXISTS stage_slot_waits (
+    account_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    requested_at REAL NOT NULL,
+    lease_expires_at REAL NOT NULL,
+    PRIMARY KEY (job_id, kind)
+);
+CREATE INDEX IF NOT EXISTS stage_slot_waits_account ON stage_slot_waits (account_id, kind, requested_at);
+'''
+
+# columns added after the first release of the queue, for databases created before them
+JOB_COLUMNS = {
+    'tenant': "TEXT NOT NULL DEFAULT ''",
+    'priority': 'INTEGER NOT NULL DEFAULT 1',
+    'cost': 'REAL NOT NULL DEFAULT 1',
+    'virtual_start': 'REAL NOT NULL DEFAULT 0',
+    'progress': 'TEXT',
+}
+LIMIT_COLUMNS = {
+    'max_snapshots': 'INTEGER',
+    'max_copies': 'INTEGER',
+}
+
+
+class DuplicateJob(Exception):
+    pass
+
+
+# raised in the handler once its worker no longer holds the job's lease
+class LeaseLost(Exception):
+    pass
+
+
+# open a database in the queue file, creating it readable by its owner only.
+# SQLite gives the -wal and -shm files the permissions of the database
+def connect(path=QUEUE_DB, **kwargs):
+    os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+    for name in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(name):
+            os.chmod(name, 0o600)
+    return sqlite3.connect(path, timeout=30, **kwargs)
+
+
+def open_queue(path=QUEUE_DB):
+    conn = connect(path, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    for table, columns in (('jobs', JOB_COLUMNS), ('account_limits', LIMIT_COLUMNS)):
+        existing = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for name, definition in columns.items():
+            if name not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+    return conn
+
+
+def seal_payload(payload):
+    data = json.dumps(payload)
+    return PAYLOAD_CIPHER.encrypt(data.encode()).decode() if PAYLOAD_CIPHER else data
+
+
+# payloads queued before AMBA_QUEUE_KEY was set are still plain JSON
+def open_payload(data):
+    if PAYLOAD_CIPHER and not data.startswith('{'):
+        data = PAYLOAD_CIPHER.decrypt(data.encode()).decode()
+    return json.loads(data)
+
+
+def job_to_dict(row):
+    job = {key: row[key] for key in row.keys() if key != 'payload'}
+    for key in ('progress', 'result', 'error'):
+        if job[key]:
+            job[key] = json.loads(job[key])
+    job['progress'] = job['progress'] or {}
+    job['priority'] = {rank: name for name, rank in PRIORITIES.items()}.get(job['priority'])
+    return job
+
+
+# queue a migration, an instance can only have one queued or running job per account.
+# the job gets a start tag for start-time fair queuing: the later of the scheduler's
+# virtual time and the tenant's last finish tag. cost/weight then moves the tenant's
+# finish tag forward, so a tenant with a big wave queues behind its own jobs only
+def enqueue_job(conn, account_id, instance_id, payload, tenant=None, priority='rehearsal',
+                cost=1, max_attempts=MAX_ATTEMPTS):
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority {priority}")
+    tenant = tenant or account_id
+    job_id = str(uuid.uuid4())
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('INSERT OR IGNORE INTO tenants (tenant) VALUES (?)', (tenant,))
+        weight, virtual_finish = conn.execute(
+            'SELECT weight, virtual_finish FROM tenants WHERE tenant = ?', (tenant,)).fetchone()
+        virtual_time = conn.execute('SELECT virtual_time FROM scheduler WHERE id = 1').fetchone()[0]
+        virtual_start = max(virtual_time, virtual_finish)
+        conn.execute(
+            'INSERT INTO jobs (job_id, account_id, instance_id, tenant, priority, cost, virtual_start, '
+            'payload, state, max_attempts, created_at) '
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+            (job_id, account_id, instance_id, tenant, PRIORITIES[priority], cost, virtual_start,
+             seal_payload(payload), max_attempts, time.time()))
+        conn.execute('UPDATE tenants SET virtual_finish = ? WHERE tenant = ?',
+                     (virtual_start + cost / weight, tenant))
+        conn.execute('COMMIT')
+    except sqlite3.IntegrityError:
+        conn.execute('ROLLBACK')
+        raise DuplicateJob(f"Instance {instance_id} already has a queued or running migration")
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return job_id
+
+
+# caps of a source account, None keeps the current value (or the default)
+def set_account_limit(conn, account_id, max_running, max_snapshots=None, max_copies=None):
+    conn.execute(
+        'INSERT INTO account_limits (account_id, max_running, max_snapshots, max_copies) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT (account_id) DO UPDATE SET max_running = excluded.max_running, '
+        'max_snapshots = COALESCE(excluded.max_snapshots, max_snapshots), '
+        'max_copies = COALESCE(excluded.max_copies, max_copies)',
+        (account_id, max_running, max_snapshots, max_copies))
+
+
+# caps of a source account, the defaults where it has no row (or no value) in account_limits
+def get_account_limits(conn, account_id):
+    row = conn.execute(
+        'SELECT COALESCE(MAX(max_running), ?) AS max_running, COALESCE(MAX(max_snapshots), ?) AS max_snapshots, '
+        'COALESCE(MAX(max_copies), ?) AS max_copies FROM account_limits WHERE account_id = ?',
+        (ACCOUNT_CONCURRENCY, ACCOUNT_SNAPSHOTS, ACCOUNT_COPIES, account_id)).fetchone()
+    return dict(row)
+
+
+def set_tenant_weight(conn, tenant, weight):
+    conn.execute(
+        'INSERT INTO tenants (tenant, weight) VALUES (?, ?) '
+        'ON CONFLICT (tenant) DO UPDATE SET weight = excluded.weight',
+        (tenant, weight))
+
+
+# jobs whose worker stopped sending heartbeats go back to the queue,
+# or fail if they used all their attempts
+def requeue_expired(conn, now):
+    conn.execute(
+        "UPDATE jobs SET state = 'failed', worker_id = NULL, lease_expires_at = NULL, "
+        "payload = NULL, finished_at = ?, error = ? "
+        "WHERE state = 'running' AND lease_expires_at < ? AND attempts >= max_attempts",
+        (now, json.dumps('lease expired'), now))
+    conn.execute(
+        "UPDATE jobs SET state = 'queued', worker_id = NULL, lease_expires_at = NULL "
+        "WHERE state = 'running' AND lease_expires_at < ?",
+        (now,))
+    conn.execute('DELETE FROM stage_slots WHERE lease_expires_at < ?', (now,))
+    conn.execute('DELETE FROM stage_slot_waits WHERE lease_expires_at < ?', (now,))
+
+
+def drop_slots(conn, job_id):
+    conn.execute('DELETE FROM stage_slots WHERE job_id = ?', (job_id,))
+    conn.execute('DELETE FROM stage_slot_waits WHERE job_id = ?', (job_id,))
+
+
+# claim the next queued job whose account is under its concurrency cap:
+# cutovers first, then the smallest start tag (fair share between tenants).
+# BEGIN IMMEDIATE takes the write lock, so two workers never claim the same job
+# and the per-account running count is exact across processes
+def claim_job(conn, worker_id, lease_seconds=LEASE_SECONDS):
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        requeue_expired(conn, now)
+        row = conn.execute(
+            "SELECT j.job_id FROM jobs j WHERE j.state = 'queued' "
+            "AND (SELECT COUNT(*) FROM jobs r WHERE r.account_id = j.account_id AND r.state = 'running') "
+            "< COALESCE((SELECT max_running FROM account_limits l WHERE l.account_id = j.account_id), ?) "
+            "ORDER BY j.priority, j.virtual_start, j.created_at LIMIT 1",
+            (ACCOUNT_CONCURRENCY,)).fetchone()
+        if row is None:
+            conn.execute('COMMIT')
+            return None
+        conn.execute(
+            "UPDATE jobs SET state = 'running', worker_id = ?, lease_expires_at = ?, "
+            "attempts = attempts + 1, started_at = ? WHERE job_id = ?",
+            (worker_id, now + lease_seconds, now, row['job_id']))
+        job = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (row['job_id'],)).fetchone()
+        conn.execute('UPDATE scheduler SET virtual_time = MAX(virtual_time, ?) WHERE id = 1',
+                     (job['virtual_start'],))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return job
+
+
+# extend the lease of the job and of its stage slots, returns False if the job is no longer ours
+def heartbeat(conn, job_id, worker_id, lease_seconds=LEASE_SECONDS):
+    lease_expires_at = time.time() + lease_seconds
+    cursor = conn.execute(
+        "UPDATE jobs SET lease_expires_at = ? WHERE job_id = ? AND worker_id = ? AND state = 'running'",
+        (lease_expires_at, job_id, worker_id))
+    if cursor.rowcount != 1:
+        return False
+    conn.execute('UPDATE stage_slots SET lease_expires_at = ? WHERE job_id = ?',
+                 (lease_expires_at, job_id))
+    conn.execute('UPDATE stage_slot_waits SET lease_expires_at = ? WHERE job_id = ?',
+                 (lease_expires_at, job_id))
+    return True
+
+
+def holds_lease(conn, job):
+    return conn.execute(
+        "SELECT 1 FROM jobs WHERE job_id = ? AND worker_id = ? AND state = 'running'",
+        (job['job_id'], job['worker_id'])).fetchone() is not None
+
+
+# record the steps the job has finished, so a retry picks up after them.
+# raises LeaseLost if the job was given to another worker, the handler must stop then
+def save_progress(job, progress):
+    conn = open_queue(job.get('queue_path', QUEUE_DB))
+    try:
+        cursor = conn.execute(
+            "UPDATE jobs SET progress = ? WHERE job_id = ? AND worker_id = ? AND state = 'running'",
+            (json.dumps(progress), job['job_id'], job['worker_id']))
+    finally:
+        conn.close()
+    if cursor.rowcount != 1:
+        raise LeaseLost(f"Lost the lease on job {job['job_id']}")
+
+
+# take count snapshot or copy slots of the job's source account if they fit under
+# the cap. A job bigger than the whole cap still runs once the account is idle.
+# Slots go out in turn: the first call queues the job (cutovers ahead of rehearsals,
+# then by arrival) and no job gets slots while one ahead of it is still waiting,
+# so small jobs cannot keep a big one waiting forever
+def acquire_slots(conn, job, kind, count, lease_seconds=LEASE_SECONDS):
+    column, default = {'snapshot': ('max_snapshots', ACCOUNT_SNAPSHOTS),
+                       'copy': ('max_copies', ACCOUNT_COPIES)}[kind]
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DELETE FROM stage_slots WHERE lease_expires_at < ?', (now,))
+        conn.execute('DELETE FROM stage_slot_waits WHERE lease_expires_at < ?', (now,))
+        conn.execute(
+            'INSERT INTO stage_slot_waits (account_id, kind, job_id, requested_at, lease_expires_at) '
+            'VALUES (?, ?, ?, ?, ?) ON CONFLICT (job_id, kind) DO UPDATE SET '
+            'lease_expires_at = excluded.lease_expires_at',
+            (job['account_id'], kind, job['job_id'], now, now + lease_seconds))
+        first = conn.execute(
+            'SELECT w.job_id FROM stage_slot_waits w WHERE w.account_id = ? AND w.kind = ? '
+            'ORDER BY COALESCE((SELECT priority FROM jobs j WHERE j.job_id = w.job_id), ?), w.requested_at '
+            'LIMIT 1',
+            (job['account_id'], kind, max(PRIORITIES.values()))).fetchone()['job_id']
+        cap = conn.execute(
+            f"SELECT COALESCE((SELECT {column} FROM account_limits WHERE account_id = ?), ?)",
+            (job['account_id'], default)).fetchone()[0]
+        in_use = conn.execute(
+            'SELECT COALESCE(SUM(count), 0) FROM stage_slots WHERE account_id = ? AND kind = ?',
+            (job['account_id'], kind)).fetchone()[0]
+        acquired = first == job['job_id'] and (in_use == 0 or in_use + count <= cap)
+        if acquired:
+            conn.execute('DELETE FROM stage_slot_waits WHERE job_id = ? AND kind = ?',
+                         (job['job_id'], kind))
+            conn.execute(
+                'INSERT OR REPLACE INTO stage_slots (account_id, kind, job_id, count, lease_expires_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (job['account_id'], kind, job['job_id'], count, now + lease_seconds))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return acquired
+
+
+def release_slots(conn, job, kind):
+    conn.execute('DELETE FROM stage_slots WHERE job_id = ? AND kind = ?', (job['job_id'], kind))
+
+
+# with stage_slots(job, 'snapshot', 3): ... waits for the slots and frees them afterwards
+class stage_slots:
+    def __init__(self, job, kind, count):
+        self.job = job
+        self.kind = kind
+        self.count = count
+
+    def __enter__(self):
+        self.conn = open_queue(self.job.get('queue_path', QUEUE_DB))
+        try:
+            while not acquire_slots(self.conn, self.job, self.kind, self.count):
+                if not holds_lease(self.conn, self.job):
+                    raise LeaseLost(f"Lost the lease on job {self.job['job_id']}")
+                time.sleep(SLOT_POLL_INTERVAL)
+        except BaseException:
+            # give up the job's turn, it would hold up every job behind it
+            self.conn.execute('DELETE FROM stage_slot_waits WHERE job_id = ? AND kind = ?',
+                              (self.job['job_id'], self.kind))
+            self.conn.close()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        release_slots(self.conn, self.job, self.kind)
+        self.conn.close()
+        return False
+
+
+# the payload holds the AWS credentials, it is dropped as soon as the job is finished.
+# a worker that lost the lease changes nothing, the job belongs to its new worker
+def complete_job(conn, job_id, worker_id, result):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        cursor = conn.execute(
+            "UPDATE jobs SET state = 'done', result = ?, payload = NULL, worker_id = NULL, "
+            "lease_expires_at = NULL, finished_at = ? WHERE job_id = ? AND worker_id = ? AND state = 'running'",
+            (json.dumps(result, default=str), time.time(), job_id, worker_id))
+        if cursor.rowcount == 1:
+            drop_slots(conn, job_id)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return cursor.rowcount == 1
+
+
+def fail_job(conn, job_id, worker_id, error):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        job = conn.execute(
+            "SELECT attempts, max_attempts FROM jobs WHERE job_id = ? AND worker_id = ? AND state = 'running'",
+            (job_id, worker_id)).fetchone()
+        if job is None:
+            conn.execute('COMMIT')
+            return False
+        drop_slots(conn, job_id)
+        if job['attempts'] < job['max_attempts']:
+            conn.execute(
+                "UPDATE jobs SET state = 'queued', worker_id = NULL, lease_expires_at = NULL, error = ? "
+                "WHERE job_id = ?",
+                (json.dumps(error), job_id))
+        else:
+            conn.execute(
+                "UPDATE jobs SET state = 'failed', worker_id = NULL, lease_expires_at = NULL, "
+                "payload = NULL, error = ?, finished_at = ? WHERE job_id = ?",
+                (json.dumps(error), time.time(), job_id))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return True
+
+
+def get_job(conn, job_id):
+    row = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+    return job_to_dict(row) if row else None
+
+
+def list_jobs(conn, state=None, limit=100, job_ids=None):
+    where, params = [], []
+    if state:
+        where.append('state = ?')
+        params.append(state)
+    if job_ids:
+        where.append(f"job_id IN ({', '.join('?' * len(job_ids))})")
+        params.extend(job_ids)
+    rows = conn.execute(
+        f"SELECT * FROM jobs {'WHERE ' + ' AND '.join(where) if where else ''} "
+        'ORDER BY created_at DESC LIMIT ?', params + [limit])
+    return [job_to_dict(row) for row in rows]
+
+
+def new_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+# claim and run jobs until stop is set. handler(payload, job) does the migration and
+# returns its result, a background thread keeps the lease alive meanwhile. The handler
+# calls save_progress between its steps, which stops it once the lease is lost; the job
+# carries the queue path so those calls write to the queue the job came from.
+# database errors (locked past the timeout) are logged and the worker carries on
+def run_worker(handler, stop, worker_id=None, poll_interval=2, path=QUEUE_DB):
+    worker_id = worker_id or new_worker_id()
+    conn = open_queue(path)
+    while not stop.is_set():
+        try:
+            job = claim_job(conn, worker_id)
+        except sqlite3.OperationalError as e:
+            print(f"Worker {worker_id} could not claim a job: {e}")
+            stop.wait(poll_interval)
+            continue
+        if job is None:
+            stop.wait(poll_interval)
+            continue
+
+        done = threading.Event()
+
+        def keep_alive(job_id=job['job_id']):
+            beat_conn = open_queue(path)
+            while not done.wait(LEASE_SECONDS / 3):
+                try:
+                    if not heartbeat(beat_conn, job_id, worker_id):
+                        print(f"Worker {worker_id} lost the lease on job {job_id}, stopping it at its next step")
+                        break
+                except sqlite3.OperationalError as e:
+                    print(f"Heartbeat of job {job_id} failed: {e}")
+            beat_conn.close()
+
+        beat = threading.Thread(target=keep_alive, daemon=True)
+        beat.start()
+        try:
+            try:
+                result = handler(open_payload(job['payload']), dict(job_to_dict(job), queue_path=path))
+            except LeaseLost as e:
+                print(f"Job {job['job_id']} stopped: {e}")
+            except Exception as e:
+                print(f"Job {job['job_id']} failed: {e}")
+                fail_job(conn, job['job_id'], worker_id, str(e))
+            else:
+                if not complete_job(conn, job['job_id'], worker_id, result):
+                    print(f"Job {job['job_id']} finished after its lease was lost, result dropped")
+        except sqlite3.OperationalError as e:
+            # the lease runs out and the job is retried from its saved progress
+            print(f"Worker {worker_id} could not record job {job['job_id']}: {e}")
+        finally:
+            done.set()
+            beat.join()
+    conn.close()
+
+
+# start count worker threads in this process, returns the event that stops them
+def start_workers(handler, count, path=QUEUE_DB):
+    stop = threading.Event()
+    for _ in range(count):
+        threading.Thread(target=run_worker, args=(handler, stop),
+                         kwargs={'path': path}, daemon=True).start()
+    return stop
@@ -1,6 +1,6 @@
 // To run this : uvicorn main:app --reload
 
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import axios from "axios";
 import "tailwindcss/tailwind.css";
 import Modal from "./components/Modal";
@@ -34,6 +34,13 @@ function App() {
   const [currentIdx, setCurrentIdx] = useState(0);
   const [isLoading, setIsLoading] = useState(false); // Add loading state
   const [isMigrationDone, setISMigrationDone] = useState(false);
+  const [sourceAccountId, setSourceAccountId] = useState("");
+  const [instanceQuery, setInstanceQuery] = useState("");
+  const [instanceTotal, setInstanceTotal] = useState(0);
+  // the latest search, responses of older ones are dropped
+  const searchId = useRef(0);
+  const [team, setTeam] = useState("");
+  const [priority, setPriority] = useState("rehearsal");
 
   //Object to store modal info: title: "VPC", Description: "Select an exsi....", Data: vpcs, selectedData: selectedVpc, setSelectedData: setSelectedVpc, isOpen: isModalOpen, setIsOpen: setIsModalOpen
   const vpcModal = {
@@ -70,21 +77,68 @@ function App() {
 
   const handleListInstances = async () => {
     try {
+      // refresh the local inventory index (skipped if it is younger than 5 minutes)
       const response = await axios.post(
-        "http://localhost:8000/list-instances",
+        "http://localhost:8000/refresh-inventory",
         {
           aws_access_key_id: awsAccessKeyId,
           aws_secret_access_key: awsSecretAccessKey,
           region_name: regionName,
-          vpc_id: "", // we don't need Vpc ID for this
+          max_age: 300,
         }
       );
-      setInstances(response.data.instances);
+      setSourceAccountId(response.data.account_id);
+      await handleSearchInstances(response.data.account_id, instanceQuery);
     } catch (error) {
       console.error("Error listing instances:", error);
     }
   };
 
+  // search the inventory index: "key=value" matches a tag exactly, anything else is a text search.
+  // every page is fetched (large accounts have more than one), the list fills in as they arrive
+  const handleSearchInstances = async (accountId, query) => {
+    const id = ++searchId.current;
+    // split on the first "=" only, tag values may contain "="
+    const separator = query.indexOf("=");
+    const key = separator >= 0 ? query.slice(0, separator) : query;
+    const value = separator >= 0 ? query.slice(separator + 1) : undefined;
+    try {
+      let items = [];
+      let pageToken = null;
+      do {
+        const response = await axios.post(
+          "http://localhost:8000/search?fields=instance_id",
+          {
+            account_id: accountId,
+            region_name: regionName,
+            resource_type: "instance",
+            tags: value !== undefined ? { [key.trim()]: value.trim() } : {},
+            text: value === undefined ? query : null,
+            page_token: pageToken,
+            page_size: 1000,
+          }
+        );
+        if (id != searchId.current) return; // a newer search has started
+        items = items.concat(response.data.items.map((item) => item.instance_id));
+        pageToken = response.data.next_page_token;
+        setInstances(items);
+        setInstanceTotal(response.data.total);
+      } while (pageToken);
+    } catch (error) {
+      console.error("Error searching instances:", error);
+    }
+  };
+
+  // search once typing pauses instead of on every keystroke
+  useEffect(() => {
+    if (sourceAccountId == "") return;
+    const timer = setTimeout(
+      () => handleSearchInstances(sourceAccountId, instanceQuery),
+      300
+    );
+    return () => clearTimeout(timer);
+  }, [instanceQuery]);
+
   const handleSelectInstance = (instanceId) => {
     if (selectedInstances.includes(instanceId)) {
       setSelectedInstances(selectedInstances.filter((id) => id !== instanceId));
@@ -111,9 +165,10 @@ function App() {
   const handle_migrate_resources = async () => {
     setIsLoading(true); // Start loading
     try {
-      // Create an array of promises for each migration task
-      const migrationPromises = selectedInstances.map((instance) => {
-        return axios.post("http://localhost:8000/migrate-instance", {
+      // Queue a migration job for each instance, the backend scheduler shares
+      // the capacity fairly between teams and runs cutovers first
+      const jobPromises = selectedInstances.map((instance) => {
+        return axios.post("http://localhost:8000/enqueue-migration", {
           source_aws_access_key_id: awsAccessKeyId,
           source_aws_secret_access_key: awsSecretAccessKey,
           source_region_name: regionName,
@@ -125,11 +180,30 @@ function App() {
           selected_vpc_id: selectedVpc,
           selected_subnet_id: selectedSubnet,
           selected_security_group_id: selectedSecurityGroup,
+          team: team || null,
+          priority: priority,
         });
       });
+      const jobIds = (await Promise.all(jobPromises)).map(
+        (response) => response.data.job_id
+      );
 
-      // Wait for all migrations to complete
-      await Promise.all(migrationPromises);
+      // Wait for all migrations to complete, one request per poll for the whole wave
+      let pending = jobIds;
+      while (pending.length > 0) {
+        await new Promise((resolve) => setTimeout(resolve, 5000));
+        const response = await axios.get("http://localhost:8000/jobs", {
+          params: { ids: pending.join(","), fields: "job_id,state,error" },
+        });
+        const jobs = response.data.jobs;
+        const failed = jobs.filter((job) => job.state == "failed");
+        if (failed.length > 0) {
+          throw new Error(`Migration failed: ${failed[0].error}`);
+        }
+        pending = jobs
+          .filter((job) => job.state != "done")
+          .map((job) => job.job_id);
+      }
       console.log("All instances migrated successfully");
       setISMigrationDone(true);
     } catch (error) {
@@ -265,6 +339,20 @@ function App() {
               List Instances
             </button>
           </div>
+          {sourceAccountId != "" && (
+            <input
+              type="text"
+              placeholder="Filter by tag, e.g. app=payments"
+              value={instanceQuery}
+              onChange={(e) => setInstanceQuery(e.target.value)}
+              className="w-full px-3 py-2 mt-1 border rounded-md focus:outline-none focus:ring focus:border-blue-300"
+            />
+          )}
+          {sourceAccountId != "" && (
+            <p className="mt-2 text-sm text-gray-500">
+              {instances.length} of {instanceTotal} instances
+            </p>
+          )}
           <ul className="mt-4 space-y-2">
             {instances.map((id, index) => (
               <li
@@ -337,6 +425,32 @@ function App() {
                 />
               </div>
 
+              <div>
+                <label className="block text-sm font-medium text-gray-700">
+                  Team
+                </label>
+                <input
+                  type="text"
+                  value={team}
+                  onChange={(e) => setTeam(e.target.value)}
+                  className="w-full px-3 py-2 mt-1 border rounded-md focus:outline-none focus:ring focus:border-blue-300"
+                />
+              </div>
+
+              <div>
+                <label className="block text-sm font-medium text-gray-700">
+                  Priority
+                </label>
+                <select
+                  value={priority}
+                  onChange={(e) => setPriority(e.target.value)}
+                  className="w-full px-3 py-2 mt-1 border rounded-md focus:outline-none focus:ring focus:border-blue-300"
+                >
+                  <option value="rehearsal">Rehearsal</option>
+                  <option value="cutover">Cutover</option>
+                </select>
+              </div>
+
               <button
                 className="w-full px-4 py-2 mt-4 font-bold text-black bg-awsOrange rounded-md hover:bg-awsOrangeDark focus:outline-none "
                 onClick={handleMigration}